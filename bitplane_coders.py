@@ -0,0 +1,366 @@
+# Entropy coders of bitplanes (see the --coder option of
+# Intercom_bitplanes).
+#
+# A coder compresses "regions" of bitplanes. The region (channel,
+# start, stop, bit) is the bit "bit" of the samples [start, stop) of
+# the channel "channel". Intercom_bitplanes sends as regions whole
+# bitplanes, and Intercom_subbands the subbands of the bitplanes. The
+# coder returns a record (bytes) per region, and the decoder needs
+# all the records of the regions of the same (channel, start, stop)
+# that are over a region to decode it (they are decoded together).
+#
+# Arithmetic_coder is an adaptive binary arithmetic coder (in its
+# rANS variant, which allows to decode with integer arithmetic and
+# without carries). The probability of each bit is estimated
+# (counting the previous bits of the region with the same context)
+# for the context of the bit:
+#
+#   0, 1, 2: the sample is not significant in the higher bitplanes,
+#            and 0, 1 or 2 of its neighbours are significant (the
+#            left one considering also the current bitplane).
+#   3:       the sample is significant in the higher bitplanes.
+#   4, 5:    sign bitplane, and the left sign is 0 or 1.
+#
+# Arithmetic coding is sequential, so, in order to use NumPy, all the
+# regions (split into segments of at most SEGMENT_LENGTH bits, which
+# are coded independently) are coded at the same time, one bit of
+# each region at each step. When decoding, each region goes two bits
+# behind the region of the bitplane over it (the context uses its
+# right neighbour), so the context of each bit is known when it is
+# decoded.
+#
+# Each record indicates the number of regions over it, so the regions
+# under a lost one are discarded by the decoder. A region whose coded
+# form would be larger than its packed bits is stored raw.
+#
+# Each step of the loops costs the same whatever the number of
+# segments, so a chunk takes about as many steps as bits has a
+# segment (more than its period with 1024 frames), and the coder is
+# not offered by --coder yet (see test/bitplanes/coders.py).
+
+import numpy as np
+
+class Arithmetic_coder:
+
+    SEGMENT_LENGTH = 256
+    CONTEXTS = 6
+    PRECISION = 12                  # Probabilities in 1/4096 units
+    M = 1 << PRECISION
+    L = 1 << 16                     # The state is in [L, L << 8)
+    MIN_FREQUENCY = 16              # Required by the single-byte renormalization
+
+    # Records: higher (u1), mode (u1), and
+    #   RAW:   the packed bits
+    #   CODED: the final state of each segment (3 bytes), the length of
+    #          each segment but the last one (2 bytes), and the bytes of
+    #          the segments.
+    RAW = 0
+    CODED = 1
+    HEADER_SIZE = 2
+    INDEPENDENT_REGIONS = False
+
+    # Sorts the regions by their (channel, start, stop) and, inside of
+    # them, by their bit (descending). Returns the order of the regions
+    # and the rank of each region (the number of regions over it).
+    @staticmethod
+    def get_ranks(regions):
+        order = sorted(range(len(regions)), key=lambda r: (regions[r][0], regions[r][1], regions[r][2], -regions[r][3]))
+        ranks = [0]*len(regions)
+        for i in range(1, len(order)):
+            if regions[order[i]][:3] == regions[order[i-1]][:3]:
+                ranks[order[i]] = ranks[order[i-1]] + 1
+        return order, ranks
+
+    # Splits the regions (sorted by get_ranks()) into segments.
+    # Returns, for each segment, its channel, its start, its length and
+    # the segment over it (-1 if none), and, for each region, the
+    # number of segments.
+    def get_segments(self, regions, order):
+        channels, starts, lengths, prevs, segments_per_region = [], [], [], [], []
+        last_segment_of = {}
+        for r in order:
+            channel, start, stop, bit = regions[r]
+            segments_per_region.append(0)
+            for s in range(start, stop, self.SEGMENT_LENGTH):
+                key = (channel, s, min(stop, s + self.SEGMENT_LENGTH))
+                prevs.append(last_segment_of.get(key, -1))
+                last_segment_of[key] = len(channels)
+                channels.append(channel)
+                starts.append(s)
+                lengths.append(key[2] - s)
+                segments_per_region[-1] += 1
+        return np.array(channels, dtype=np.intp), np.array(starts, dtype=np.intp), np.array(lengths, dtype=np.intp), np.array(prevs, dtype=np.intp), segments_per_region
+
+    # The probability (as a frequency) of the bit 1 after a number of
+    # bits and ones of the same context (Krichevsky-Trofimov estimator),
+    # indexed by bits*(SEGMENT_LENGTH + 1) + ones.
+    def __init__(self):
+        ones, bits = np.meshgrid(np.arange(self.SEGMENT_LENGTH + 1), np.arange(self.SEGMENT_LENGTH + 1))
+        self.frequencies = np.clip(((2*ones + 1) << self.PRECISION)//(2*bits + 2), self.MIN_FREQUENCY, self.M - self.MIN_FREQUENCY).reshape(-1)
+
+    # samples is a (channels, frames) array of unsigned integers.
+    # Returns the records of the regions.
+    def encode(self, samples, regions, sign_bit):
+        order, ranks = self.get_ranks(regions)
+        channels, starts, lengths, prevs, segments_per_region = self.get_segments(regions, order)
+        number_of_segments = len(channels)
+        width = max(lengths, default=0)
+        bits = np.repeat([regions[r][3] for r in order], segments_per_region).astype(samples.dtype)
+        signs = bits == sign_bit
+        segment_ranks = np.repeat([ranks[r] for r in order], segments_per_region)
+
+        #Bits of the segments, by position, with a column of 0s at the
+        #end (the segment over the segments of rank 0) and a row of 0s
+        #at both sides (the neighbours of the first and the last bits)
+        positions = np.arange(width)[:, None]
+        valid = positions < lengths
+        B = np.zeros((width + 2, number_of_segments + 1), dtype=np.int8)
+        B[1:-1, :-1] = (samples[channels, np.minimum(starts + positions, samples.shape[1] - 1)] >> bits) & 1
+        B[1:-1, :-1] &= valid
+
+        #Significance in the current and the higher bitplanes
+        significance = np.zeros_like(B)
+        for rank in range(int(segment_ranks.max(initial=0)) + 1):
+            segments = np.flatnonzero(segment_ranks == rank)
+            significance[:, segments] = significance[:, prevs[segments]] | np.where(signs[segments], 0, B[:, segments])
+        above = significance[:, prevs]
+        contexts = np.where(signs, 4 + B[:-2, :-1], np.where(above[1:-1], 3, significance[:-2, :-1] + above[2:]))
+
+        #Counts (bits*(SEGMENT_LENGTH + 1) + ones) of the previous bits
+        #of the segment in the same context. The counts of the contexts
+        #0-2 and 3-5 are accumulated in fields of 17 bits of two arrays.
+        bits = B[1:-1, :-1]
+        shifts = (contexts % 3)*17
+        increments = (((self.SEGMENT_LENGTH + 1) + bits.astype(np.int64)) << shifts)*valid
+        high_contexts = contexts >= 3
+        low_counts = np.cumsum(np.where(high_contexts, 0, increments), axis=0)
+        high_counts = np.cumsum(np.where(high_contexts, increments, 0), axis=0)
+        counts = ((np.where(high_contexts, high_counts, low_counts) - increments) >> shifts) & 0x1FFFF
+
+        #Frequency and cumulative frequency of each bit. The padding
+        #(F=M, C=0) does not modify the state.
+        F1 = self.frequencies.take(counts)*valid
+        F0 = self.M - F1
+        F = np.where(bits, F1, F0)
+        C = np.where(bits, F0, 0)
+
+        #rANS, from the last bit to the first one. At most one byte is
+        #output (by renormalization) before coding each bit (see
+        #MIN_FREQUENCY), so the bytes are stored by position, with a
+        #mask of the output ones, and each stream is gathered at the
+        #end. The coding of the bit, (x//f << PRECISION) + x%f + C, is
+        #computed as x + (x//f)*(M - f) + C.
+        x = np.full(number_of_segments, self.L, dtype=np.int64)
+        renormalization_thresholds = F << self.PRECISION
+        G = self.M - F
+        output = np.empty((width, number_of_segments), dtype=np.uint8)
+        output_mask = np.empty((width, number_of_segments), dtype=bool)
+        for position in range(width - 1, -1, -1):
+            renormalize = np.greater_equal(x, renormalization_thresholds[position], out=output_mask[position])
+            output[position] = x
+            x >>= renormalize << 3
+            x += (x//F[position])*G[position] + C[position]
+        output_lengths = np.count_nonzero(output_mask, axis=0)
+        output = output.T[output_mask.T]
+        output_starts = np.cumsum(output_lengths) - output_lengths
+
+        #Records (the segments are coded only if the result is smaller)
+        records = [None]*len(regions)
+        s = 0
+        for r, number_of_segments_of_r in zip(order, segments_per_region):
+            segments = range(s, s + number_of_segments_of_r)
+            s += number_of_segments_of_r
+            coded_length = sum(3 + int(output_lengths[i]) for i in segments) + 2*(number_of_segments_of_r - 1)
+            raw = np.packbits(B[1:-1, segments.start:segments.stop].T[valid[:, segments.start:segments.stop].T])
+            if coded_length < len(raw):
+                states = b"".join(int(x[i]).to_bytes(3, "big") for i in segments)
+                stream_lengths = b"".join(int(output_lengths[i]).to_bytes(2, "big") for i in segments[:-1])
+                streams = output[output_starts[segments.start]:output_starts[segments.stop - 1] + output_lengths[segments.stop - 1]].tobytes()
+                records[r] = bytes((ranks[r], self.CODED)) + states + stream_lengths + streams
+            else:
+                records[r] = bytes((ranks[r], self.RAW)) + raw.tobytes()
+        return records
+
+    # Returns the bits of the regions of the records (None for the
+    # regions that can not be decoded because a region over them is
+    # missing).
+    def decode(self, records, regions, sign_bit):
+        order, ranks = self.get_ranks(regions)
+        bits = [None]*len(regions)
+
+        #The records whose count of higher regions does not match
+        #their rank, and the following ones of the same (channel,
+        #start, stop), are discarded
+        for i, r in enumerate(order):
+            if records[r][0] == ranks[r] and (ranks[r] == 0 or bits[order[i-1]] is not None):
+                bits[r] = True
+        order = [r for r in order if bits[r] is not None]
+        if not order:
+            return bits
+        channels, starts, lengths, prevs, segments_per_region = self.get_segments(regions, order)
+        number_of_segments = len(channels)
+        width = max(lengths)
+        signs = np.repeat([regions[r][3] == sign_bit for r in order], segments_per_region)
+        segment_ranks = np.repeat([ranks[r] for r in order], segments_per_region)
+        number_of_steps = width + 2*int(segment_ranks.max())
+        prevs[prevs < 0] = number_of_segments
+
+        #The bit of the position p of a segment of rank r is decoded at
+        #the step p + 2*r
+        steps = np.arange(number_of_steps)[:, None] - 2*segment_ranks
+        active = (steps >= 0) & (steps < lengths)
+
+        #Final states, streams and raw bits
+        x = np.full(number_of_segments, self.L, dtype=np.int64)
+        raw = np.zeros(number_of_segments, dtype=bool)
+        raw_bits = np.zeros((number_of_segments, number_of_steps), dtype=bool)
+        streams = []
+        s = 0
+        for r, number_of_segments_of_r in zip(order, segments_per_region):
+            segments = slice(s, s + number_of_segments_of_r)
+            s += number_of_segments_of_r
+            record = records[r]
+            if record[1] == self.RAW:
+                raw[segments] = True
+                raw_bits[segments][active.T[segments]] = np.unpackbits(np.frombuffer(record, np.uint8, offset=2))[:np.sum(lengths[segments])]
+                streams.extend([b""]*number_of_segments_of_r)
+                continue
+            offset = 2
+            x[segments] = [int.from_bytes(record[offset + 3*i:offset + 3*i + 3], "big") for i in range(number_of_segments_of_r)]
+            offset += 3*number_of_segments_of_r
+            stream_lengths = [int.from_bytes(record[offset + 2*i:offset + 2*i + 2], "big") for i in range(number_of_segments_of_r - 1)]
+            offset += 2*(number_of_segments_of_r - 1)
+            stream_lengths.append(len(record) - offset - sum(stream_lengths))
+            for length in stream_lengths:
+                streams.append(record[offset:offset + length])
+                offset += length
+        stream_size = max(len(stream) for stream in streams) + 1
+        S = np.zeros(number_of_segments*stream_size, dtype=np.int64)
+        for s, stream in enumerate(streams):
+            S[s*stream_size:s*stream_size + len(stream)] = np.frombuffer(stream, np.uint8)
+        stream_pointers = np.arange(number_of_segments)*stream_size
+        raw_bits = np.ascontiguousarray(raw_bits.T)
+        coded = (active & ~raw).astype(np.int64)
+
+        #Bits and significance, by step (with 2 rows of 0s before the
+        #first step, and a column of 0s for the segments of rank 0)
+        B = np.zeros((number_of_steps + 2, number_of_segments + 1), dtype=np.int8)
+        significance = np.zeros_like(B)
+        not_signs = ~signs
+        #Counts of each (segment, context), as bits*(SEGMENT_LENGTH + 1)
+        #+ ones, indexed by segment*CONTEXTS + context
+        counts = np.zeros(number_of_segments*self.CONTEXTS, dtype=np.intp)
+        context_base = np.arange(number_of_segments)*self.CONTEXTS
+        sign_context_base = context_base + 4
+        refinement_context = context_base + 3
+        count_increments = np.where(active, self.SEGMENT_LENGTH + 1, 0)
+        #The significance over the right neighbour is the one over the
+        #bit of the next step
+        above_right = significance[0].take(prevs)
+        for step in range(number_of_steps):
+            i = step + 2
+            above, above_right = above_right, significance[i-1].take(prevs)
+            k = np.where(signs, sign_context_base + B[i-1, :-1], np.where(above, refinement_context, context_base + significance[i-1, :-1] + above_right))
+            #Non-active (and raw) segments use f1=0, which does not
+            #modify the state
+            f1 = self.frequencies.take(counts.take(k))*coded[step]
+            slot = x & (self.M - 1)
+            f0 = self.M - f1
+            bit = slot >= f0
+            x = np.where(bit, f1, f0)*(x >> self.PRECISION) + slot - np.where(bit, f0, 0)
+            #At most one byte is read by renormalization (see
+            #MIN_FREQUENCY)
+            renormalize = x < self.L
+            x = np.where(renormalize, (x << 8) | S.take(stream_pointers), x)
+            stream_pointers += renormalize
+            #The raw segments decode 0s (as the non-active ones), and
+            #take their bits as they are
+            bit |= raw_bits[step]
+            B[i, :-1] = bit
+            significance[i, :-1] = above | (bit & not_signs)
+            counts[k] += count_increments[step] + bit
+        decoded = B[2:, :-1].T[active.T]
+        s = 0
+        for r in order:
+            length = regions[r][2] - regions[r][1]
+            bits[r] = decoded[s:s + length]
+            s += length
+        return bits
+
+# Rice_coder codes the runs of 0s before each 1 of a region with
+# Golomb-Rice codes of a parameter k per region (chosen from the mean
+# length of the runs). The record has the number of runs (2 bytes), k
+# (1 byte), and the bits of the codes: first the k low bits of all the
+# runs and then the high bits of the runs in unary (as 0s ended by a
+# 1), so that the runs are found with np.diff(np.flatnonzero()). The
+# regions are coded independently, and only when the code is smaller
+# than the packed bits (otherwise the record is None).
+class Rice_coder:
+
+    HEADER_SIZE = 3
+    INDEPENDENT_REGIONS = True
+
+    # Regions with more 1s than this fraction of their bits are sent
+    # raw (a Rice code needs more than 1 bit per run).
+    MAX_DENSITY = 1/4
+
+    def encode(self, samples, regions, sign_bit):
+        records = [None]*len(regions)
+        bits = [(samples[channel, start:stop] >> bit) & 1 for channel, start, stop, bit in regions]
+        candidates = [r for r in range(len(regions)) if np.count_nonzero(bits[r]) < len(bits[r])*self.MAX_DENSITY]
+        if not candidates:
+            return records
+        lengths = np.array([len(bits[r]) for r in candidates], dtype=np.intp)
+        region_starts = np.cumsum(lengths) - lengths
+        bits = np.concatenate([bits[r] for r in candidates])
+
+        #Runs of 0s before each 1 (the first run of a region starts at the region)
+        ones = np.flatnonzero(bits)
+        region_of_ones = np.searchsorted(region_starts, ones, side="right") - 1
+        previous_ones = np.roll(ones, 1)
+        first_ones = np.diff(region_of_ones, prepend=-1) != 0
+        previous_ones[first_ones] = region_starts[region_of_ones[first_ones]] - 1
+        runs = ones - previous_ones - 1
+
+        #Rice parameter of each region, and size of its code
+        number_of_runs = np.bincount(region_of_ones, minlength=len(candidates))
+        mean_runs = (lengths - number_of_runs)/np.maximum(number_of_runs, 1)
+        ks = np.maximum(0, np.floor(np.log2(np.maximum(mean_runs*np.log(2), 1)))).astype(np.intp)
+        k_of_runs = ks[region_of_ones]
+        high_bits = runs >> k_of_runs
+        code_bits = number_of_runs*ks + np.bincount(region_of_ones, weights=high_bits + 1, minlength=len(candidates)).astype(np.intp)
+        coded = (self.HEADER_SIZE + (code_bits + 7)//8 < (lengths + 7)//8) & (number_of_runs < 1 << 16)
+
+        #The low bits of the runs, by region, followed by the high bits
+        #in unary, each region in its own bytes
+        code_bytes = (code_bits + 7)//8
+        code_starts = (np.cumsum(code_bytes) - code_bytes)*8
+        first_run_of_region = (np.cumsum(number_of_runs) - number_of_runs)[region_of_ones]
+        run_in_region = np.arange(len(runs)) - first_run_of_region
+        stream = np.zeros(int(np.sum(code_bytes))*8, dtype=np.uint8)
+        low_bits_starts = code_starts[region_of_ones] + run_in_region*k_of_runs
+        for j in range(int(ks.max(initial=0))):
+            has_bit_j = k_of_runs > j
+            stream[low_bits_starts[has_bit_j] + j] = (runs[has_bit_j] >> (k_of_runs[has_bit_j] - 1 - j)) & 1
+        unary_ends = np.cumsum(high_bits + 1) - 1
+        stream[(code_starts + number_of_runs*ks)[region_of_ones] + unary_ends - (unary_ends - high_bits)[first_run_of_region]] = 1
+        stream = np.packbits(stream)
+
+        for i in np.flatnonzero(coded):
+            header = int(number_of_runs[i]).to_bytes(2, "big") + bytes((int(ks[i]),))
+            records[candidates[i]] = header + stream[code_starts[i]//8:code_starts[i]//8 + code_bytes[i]].tobytes()
+        return records
+
+    def decode(self, records, regions, sign_bit):
+        result = []
+        for record, (channel, start, stop, bit) in zip(records, regions):
+            number_of_runs = int.from_bytes(record[:2], "big")
+            k = record[2]
+            stream = np.unpackbits(np.frombuffer(record, np.uint8, offset=self.HEADER_SIZE))
+            low_bits = stream[:number_of_runs*k].reshape(number_of_runs, k)
+            high_bits = np.diff(np.flatnonzero(stream[number_of_runs*k:])[:number_of_runs], prepend=-1) - 1
+            runs = (high_bits << k) | (low_bits @ (1 << np.arange(k - 1, -1, -1)))
+            bits = np.zeros(stop - start, dtype=np.uint8)
+            bits[np.cumsum(runs + 1) - 1] = 1
+            result.append(bits)
+        return result
@@ -8,11 +8,16 @@
 #
 # Based on: https://python-sounddevice.readthedocs.io/en/0.3.13/_downloads/wire.py
 
-import sounddevice as sd                                                        # https://python-sounddevice.readthedocs.io
+try:
+    import sounddevice as sd                                                    # https://python-sounddevice.readthedocs.io
+except (ImportError, OSError):                                                  # No PortAudio: only usable offline (see test/loopback)
+    sd = None
 import numpy as np                                                              # https://numpy.org/
 import argparse                                                                 # https://docs.python.org/3/library/argparse.html
 import socket                                                                   # https://docs.python.org/3/library/socket.html
 import queue                                                                    # https://docs.python.org/3/library/queue.html
+from time import perf_counter
+from metrics import Metrics
 
 if __debug__:
     import sys
@@ -20,6 +25,7 @@ if __debug__:
 class Intercom:
 
     MAX_MESSAGE_SIZE = 32768                                                    # In bytes
+    MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)                           # Not available in Windows
 
     def init(self, args):
         self.number_of_channels = args.number_of_channels
@@ -36,6 +42,24 @@ class Intercom:
         self.receiving_sock.bind(self.listening_endpoint)
         self.q = queue.Queue(maxsize=100000)
 
+        # Pool of preallocated buffers where the receiver drains, in
+        # a single wakeup, all the datagrams pending in the socket.
+        # The time of the wakeup is the arrival time of the batch.
+        self.receive_batch_size = args.receive_batch_size
+        self.wakeup_time = 0.0
+        if Intercom.MSG_DONTWAIT == 0:
+            self.receive_batch_size = 1
+        self.receive_pool = [bytearray(Intercom.MAX_MESSAGE_SIZE) for i in range(self.receive_batch_size)]
+        self.receive_views = [memoryview(slot) for slot in self.receive_pool]
+        self.received_sizes = [0] * self.receive_batch_size
+
+        # Metrics of the session (see metrics.py), exported at the
+        # endpoint given by --metrics.
+        self.metrics = None
+        if args.metrics:
+            self.metrics = Metrics()
+            self.metrics.serve(args.metrics)
+
         if __debug__:
             print(f"number_of_channels={self.number_of_channels}")
             print(f"frames_per_second={self.frames_per_second}")
@@ -45,15 +69,39 @@ class Intercom:
             print(f"destination_IP_address={self.destination_IP_addr}")
             print(f"destination_port={self.destination_port}")
             print(f"bytes_per_chunk={self.bytes_per_chunk}")
+            print(f"receive_batch_size={self.receive_batch_size}")
+            print(f"metrics={args.metrics}")
 
     def generate_zero_chunk(self):
         cell = np.zeros((self.frames_per_chunk, self.number_of_channels), np.int16)
         return cell
 
-    def receive_and_buffer(self):
-        message, source_address = self.receiving_sock.recvfrom(Intercom.MAX_MESSAGE_SIZE)
-        chunk = np.frombuffer(message, np.int16).reshape(self.frames_per_chunk, self.number_of_channels)
+    def buffer_message(self, message):
+        chunk = np.frombuffer(message, np.int16).reshape(self.frames_per_chunk, self.number_of_channels).copy()
         self.q.put(chunk)
+
+    # Waits for a datagram and, after that, reads without blocking
+    # the rest of datagrams that are waiting in the socket (up to
+    # receive_batch_size), all of them into the pool. The batch is
+    # decoded only when the socket has been drained. Returns the
+    # chunk number of the first datagram (if any).
+    def receive_and_buffer(self):
+        self.received_sizes[0] = self.receiving_sock.recv_into(self.receive_pool[0])
+        self.wakeup_time = perf_counter()
+        number_of_messages = 1
+        try:
+            while number_of_messages < self.receive_batch_size:
+                self.received_sizes[number_of_messages] = self.receiving_sock.recv_into(self.receive_pool[number_of_messages], 0, Intercom.MSG_DONTWAIT)
+                number_of_messages += 1
+        except BlockingIOError:
+            pass
+        if self.metrics:
+            self.metrics.packets_received += number_of_messages
+            self.metrics.bytes_received += sum(self.received_sizes[:number_of_messages])
+        first_chunk_number = self.buffer_message(self.receive_views[0][:self.received_sizes[0]])
+        for i in range(1, number_of_messages):
+            self.buffer_message(self.receive_views[i][:self.received_sizes[i]])
+        return first_chunk_number
         
     def record_send_and_play(self, indata, outdata, frames, time, status):
         self.sending_sock.sendto(indata, (self.destination_IP_addr, self.destination_port))
@@ -61,12 +109,21 @@ class Intercom:
             chunk = self.q.get_nowait()
         except queue.Empty:
             chunk = self.generate_zero_chunk()
+            if self.metrics:
+                self.metrics.empty_chunks_played += 1
         outdata[:] = chunk
+        if self.metrics:
+            self.metrics.packets_sent += 1
+            self.metrics.bytes_sent += indata.nbytes
+            self.metrics.chunks_played += 1
         if __debug__:
             sys.stderr.write("."); sys.stderr.flush()
             
     def run(self):
-        with sd.Stream(samplerate=self.frames_per_second, blocksize=self.frames_per_chunk, dtype=np.int16, channels=self.number_of_channels, callback=self.record_send_and_play):
+        callback = self.record_send_and_play
+        if self.metrics:
+            callback = self.metrics.counted_callback(callback)
+        with sd.Stream(samplerate=self.frames_per_second, blocksize=self.frames_per_chunk, dtype=np.int16, channels=self.number_of_channels, callback=callback):
             print("-=- Press <CTRL> + <c> to quit -=-")
             while True:
                 self.receive_and_buffer()
@@ -79,6 +136,8 @@ class Intercom:
         parser.add_argument("-p", "--mlp", help="My listening port.", type=int, default=4444)
         parser.add_argument("-i", "--ilp", help="Interlocutor's listening port.", type=int, default=4444)
         parser.add_argument("-a", "--ia", help="Interlocutor's IP address or name.", type=str, default="localhost")
+        parser.add_argument("-me", "--metrics", help="Endpoint (port, address:port or path of a UNIX socket) where the metrics are served in the Prometheus format.", type=str, default=None)
+        parser.add_argument("-rb", "--receive_batch_size", help="Maximum number of datagrams read in each wakeup of the receiver.", type=int, default=64)
         return parser
 
 if __name__ == "__main__":
@@ -1,14 +1,40 @@
 # Transmiting in bitplanes.
 #
 # The 16 planes of each chunk are transmitted from the most
-# significant one to the least significant, each in a different
-# packet.
+# significant one to the least significant. Consecutive bitplanes are
+# packed in the same packet while it fits in the MTU. A bitmap in the
+# header indicates the bitplanes that the packet carries (the
+# payload has them in the same order, from the most significant
+# one).
+#
+# A coder whose regions are not independent (as the adaptive
+# arithmetic coder of bitplane_coders.py) sends each bitplane as a
+# record (preceded by its length in 2 bytes) instead of packed. The
+# received records of a chunk are decoded together by the receiver,
+# when the records of another chunk start to arrive (and again, if
+# more records of the chunk arrive later, ORing only the bitplanes
+# that were not decoded before). Only the receiver thread touches the
+# records, so the audio callback never decodes them: a chunk is
+# played with the bitplanes decoded before (as with the bitplanes
+# that arrive late). Such a coder is timed with a chunk of noise (its
+# worst case) before running, and refused if it can not code and
+# decode a chunk in the chunk period (see -s). The arithmetic coder
+# is not offered by --coder yet: it runs one bit position per Python
+# step (about 25 ms per chunk of 1024 stereo frames, more than its
+# period) and, on DWT coefficients, it is beaten by the Rice coder
+# (see test/bitplanes/coders.py).
+#
+# With --coder rice, the runs of 0s of the bitplanes are coded with
+# Golomb-Rice codes, but only the bitplanes whose code is smaller are
+# sent coded (with its length). Another bitmap in the header
+# indicates which ones. Each coded bitplane is decoded when it is
+# received.
 
-import sounddevice as sd
 import numpy as np
-import struct
+from time import perf_counter
 from intercom import Intercom
 from intercom_buffer import Intercom_buffer
+from bitplane_coders import Rice_coder
 
 if __debug__:
     import sys
@@ -17,31 +43,249 @@ class Intercom_bitplanes(Intercom_buffer):
 
     def init(self, args):
         Intercom_buffer.init(self, args)
-        self.packet_format = f"!HB{self.frames_per_chunk//8}B"
+        self.coder = None
+        if args.coder == "rice":
+            self.coder = Rice_coder()
+        #The records received for each cell, the chunk they belong to,
+        #the bitplanes of them already decoded into the cell, and the
+        #cell of the last received record (only used by the receiver)
+        self.received_records = [{} for _ in range(self.cells_in_buffer)]
+        self.received_records_chunk_number = [None]*self.cells_in_buffer
+        self.decoded_records = [set() for _ in range(self.cells_in_buffer)]
+        self.last_record_cell = None
+        #The bit that holds the sign (a context of the coder)
+        self.sign_bit_position = 15
+        self.set_bitplanes_packet_format([("chunk_number", ">u2"), ("bitmap", ">u8")])
         self.number_of_bitplanes_to_send = 16*self.number_of_channels
+        self.set_bitplane_cells(self._buffer)
+        if __debug__:
+            print(f"coder={args.coder}")
+
+    # Selects the buffer where the received bitplanes are
+    # reassembled, and builds, for its dtype, the table that maps
+    # each byte of a (packed) bitplane b to the 8 samples that it
+    # contributes, already shifted to the position b.
+    def set_bitplane_cells(self, cells):
+        self.bitplane_cells = cells
+        bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(f"u{cells.dtype.itemsize}")
+        shifts = np.arange(cells.dtype.itemsize*8, dtype=bits.dtype)
+        self.bitplane_table = (bits << shifts[:, None, None]).view(cells.dtype)
+
+    # The samples contributed by the bitplane are gathered from the
+    # table (one lookup per byte) and ORed into the cell.
+    def buffer_bitplane(self, chunk_number, bitplane_number, bitplane):
+        self.bitplane_cells[chunk_number % self.cells_in_buffer][:, bitplane_number % self.number_of_channels] |= self.bitplane_table[bitplane_number//self.number_of_channels].take(bitplane, axis=0).reshape(-1)
+
+    # Buffers the bitplanes of a packet, indicated by the bitmap (and
+    # the coded ones by the coded_bitmap). Returns the number of
+    # bitplanes.
+    def buffer_bitplanes(self, chunk_number, bitmap, payload, coded_bitmap=0):
+        bytes_per_bitplane = self.frames_per_chunk//8
+        number_of_bitplanes = 0
+        offset = 0
+        while bitmap:
+            bitplane_number = bitmap.bit_length() - 1
+            bitmap ^= 1 << bitplane_number
+            if (coded_bitmap >> bitplane_number) & 1:
+                offset = self.buffer_record(chunk_number, bitplane_number, payload, offset)
+            else:
+                self.buffer_bitplane(chunk_number, bitplane_number, payload[offset:offset + bytes_per_bitplane])
+                offset += bytes_per_bitplane
+            number_of_bitplanes += 1
+        return number_of_bitplanes
+
+    # The region (channel, start, stop, bit) of the samples of a chunk
+    # that a bitplane covers.
+    def get_region(self, bitplane_number):
+        return (bitplane_number % self.number_of_channels, 0, self.frames_per_chunk, bitplane_number//self.number_of_channels)
+
+    # The bitmap of the coded bitplanes of a received packet: the ones
+    # indicated in the header with a coder of independent regions (as
+    # the Rice coder), and all of them with the rest.
+    def get_coded_bitmap(self, header):
+        if not self.coder:
+            return 0
+        if self.coder.INDEPENDENT_REGIONS:
+            return int(header["coded_bitmap"])
+        return (1 << 64) - 1
+
+    # Stores (a copy of) the record that starts at the offset of the
+    # payload, until the chunk is played. The records of an older
+    # chunk that uses the same cell are discarded. When the record
+    # belongs to another cell than the previous one, the records of
+    # that cell are decoded. The records of independent regions are
+    # decoded directly. Returns the offset of the next record.
+    def buffer_record(self, chunk_number, bitplane_number, payload, offset):
+        cell = chunk_number % self.cells_in_buffer
+        length = (int(payload[offset]) << 8) | int(payload[offset + 1])
+        record = payload[offset + 2:offset + 2 + length].tobytes()
+        if self.coder.INDEPENDENT_REGIONS:
+            region = self.get_region(bitplane_number)
+            self.buffer_region(cell, region, self.coder.decode([record], [region], self.sign_bit_position)[0])
+        else:
+            if self.received_records_chunk_number[cell] != chunk_number:
+                self.received_records[cell].clear()
+                self.decoded_records[cell].clear()
+                self.received_records_chunk_number[cell] = chunk_number
+            self.received_records[cell][bitplane_number] = record
+            if self.last_record_cell != cell:
+                if self.last_record_cell is not None:
+                    self.decode_bitplanes(self.last_record_cell)
+                self.last_record_cell = cell
+        return offset + 2 + length
+
+    # ORs the (unpacked) bits of a region into a cell.
+    def buffer_region(self, cell, region, bits):
+        channel, start, stop, bit = region
+        self.bitplane_cells[cell][start:stop, channel] |= self.bitplane_table[bit].take(np.packbits(bits), axis=0).reshape(-1)
+
+    # Decodes the records received for a cell, if some of them have
+    # not been decoded yet, and ORs into it the bitplanes that were
+    # not decoded before (the cell can have been played and cleared
+    # since then). The bitplanes that can not be decoded (because a
+    # higher bitplane of the same region was lost) are ignored.
+    def decode_bitplanes(self, cell):
+        records = self.received_records[cell]
+        decoded = self.decoded_records[cell]
+        if len(decoded) == len(records):
+            return
+        bitplane_numbers = list(records)
+        regions = [self.get_region(bitplane_number) for bitplane_number in bitplane_numbers]
+        for bitplane_number, region, bits in zip(bitplane_numbers, regions, self.coder.decode([records[n] for n in bitplane_numbers], regions, self.sign_bit_position)):
+            if bits is not None and bitplane_number not in decoded:
+                self.buffer_region(cell, region, bits)
+                decoded.add(bitplane_number)
 
-    def receive_and_buffer(self):
-        message, source_address = self.receiving_sock.recvfrom(Intercom.MAX_MESSAGE_SIZE)
-        received_chunk_number, received_bitplane_number, *bitplane = struct.unpack(self.packet_format, message)
-        bitplane = np.asarray(bitplane, dtype=np.uint8)
-        bitplane = np.unpackbits(bitplane)
-        bitplane = bitplane.astype(np.int16)
-        self._buffer[received_chunk_number % self.cells_in_buffer][:, received_bitplane_number % self.number_of_channels] |= (bitplane << received_bitplane_number//self.number_of_channels)
+    # Entropy codes the bitplanes of the chunk that can be sent. After
+    # that, self.records[n] is the record (with its length) of the
+    # bitplane n, or None if it is sent packed.
+    def encode_bitplanes(self, indata, bitplane_numbers):
+        samples = np.ascontiguousarray(indata.T).view(f"u{indata.dtype.itemsize}")
+        bitplane_numbers = list(bitplane_numbers)
+        self.records = {}
+        for bitplane_number, record in zip(bitplane_numbers, self.coder.encode(samples, [self.get_region(n) for n in bitplane_numbers], self.sign_bit_position)):
+            if record is None:
+                self.records[bitplane_number] = None
+            else:
+                self.records[bitplane_number] = np.frombuffer(len(record).to_bytes(2, "big") + record, np.uint8)
+
+    def is_coded(self, bitplane_number):
+        return self.coder is not None and self.records[bitplane_number] is not None
+
+    # The number of regions of a chunk (see get_region).
+    def get_number_of_regions(self):
+        return 16*self.number_of_channels
+
+    # Times the coding and the decoding of all the regions of a chunk
+    # of noise, and refuses the coder if they do not fit in the chunk
+    # period (the encoder runs in the audio callback, or in the sender
+    # stage, and the decoder in the receiver, but all of them share
+    # the interpreter).
+    def check_coder_speed(self):
+        regions = [self.get_region(n) for n in range(self.get_number_of_regions())]
+        samples_dtype = np.dtype(f"u{self.bitplane_cells.dtype.itemsize}")
+        samples = np.random.default_rng(0).integers(0, np.iinfo(samples_dtype).max, (self.number_of_channels, self.frames_per_chunk), dtype=samples_dtype, endpoint=True)
+        encoding_time = decoding_time = float("inf")
+        for _ in range(3):
+            start = perf_counter()
+            records = self.coder.encode(samples, regions, self.sign_bit_position)
+            middle = perf_counter()
+            self.coder.decode(records, regions, self.sign_bit_position)
+            encoding_time, decoding_time = min(encoding_time, middle - start), min(decoding_time, perf_counter() - middle)
+        if __debug__:
+            print(f"coder time per chunk: encode={encoding_time*1000:.1f} decode={decoding_time*1000:.1f} period={self.chunk_period*1000:.1f} (ms)")
+        if encoding_time + decoding_time > self.chunk_period:
+            raise SystemExit(f"{type(self.coder).__name__} can not code and decode a chunk of {self.frames_per_chunk} frames ({(encoding_time + decoding_time)*1000:.1f} ms) in its period ({self.chunk_period*1000:.1f} ms): use larger chunks (-s) or another coder")
+
+    def buffer_message(self, message):
+        header, payload = self.unpack(message)
+        received_chunk_number = int(header["chunk_number"])
+        self.buffer_bitplanes(received_chunk_number, int(header["bitmap"]), payload, self.get_coded_bitmap(header))
         return received_chunk_number
 
-    def send_bitplane(self, indata, bitplane_number):
-        bitplane = (indata[:, bitplane_number%self.number_of_channels] >> bitplane_number//self.number_of_channels) & 1
-        bitplane = bitplane.astype(np.uint8)
-        bitplane = np.packbits(bitplane)
-        message = struct.pack(self.packet_format, self.recorded_chunk_number, bitplane_number, *bitplane)
-        self.sending_sock.sendto(message, (self.destination_IP_addr, self.destination_port))
+    # The payload of a packet can hold as many bitplanes as fit in the
+    # MTU (at least one). The coded bitplanes have different sizes, so
+    # then it can hold as many bytes as fit in the MTU (at least the
+    # record of a bitplane stored raw). The Rice coder needs the bitmap
+    # of the coded bitplanes.
+    def set_bitplanes_packet_format(self, header_dtype):
+        if self.coder and self.coder.INDEPENDENT_REGIONS:
+            header_dtype = header_dtype + [("coded_bitmap", ">u8")]
+        bytes_per_bitplane = self.frames_per_chunk//8
+        bytes_per_packet = self.mtu - Intercom_buffer.IP_UDP_HEADERS_SIZE - np.dtype(header_dtype).itemsize
+        if self.coder:
+            payload_size = max(2 + self.coder.HEADER_SIZE + bytes_per_bitplane, bytes_per_packet)
+        else:
+            payload_size = max(1, bytes_per_packet//bytes_per_bitplane)*bytes_per_bitplane
+        self.set_packet_format(header_dtype, np.uint8, payload_size)
+        self.packed_bytes = 0
+        self.packed_bitmap = 0
+        self.packed_coded_bitmap = 0
+
+    # Extracts, at once, all the bitplanes of a chunk. The samples of
+    # each channel (seen as unsigned integers) are ANDed with a mask
+    # per bit, and the resulting booleans are packed along the
+    # frames. After that, self.bitplanes[b, c] is the (packed)
+    # bitplane b of the channel c. If bits is given, only these
+    # bitplanes are extracted (the rest are undefined).
+    def extract_bitplanes(self, indata, bits=None):
+        samples = np.ascontiguousarray(indata.T).view(f"u{indata.dtype.itemsize}")
+        if bits is None:
+            masks = np.left_shift(1, np.arange(indata.dtype.itemsize*8, dtype=samples.dtype), dtype=samples.dtype)
+            self.bitplanes = np.packbits((samples & masks[:, None, None]).astype(bool), axis=2)
+        else:
+            masks = np.left_shift(1, np.asarray(bits, dtype=samples.dtype), dtype=samples.dtype)
+            self.bitplanes = np.empty((indata.dtype.itemsize*8, indata.shape[1], indata.shape[0]//8), dtype=np.uint8)
+            self.bitplanes[bits] = np.packbits((samples & masks[:, None, None]).astype(bool), axis=2)
+
+    def get_bitplane(self, bitplane_number):
+        if self.is_coded(bitplane_number):
+            return self.records[bitplane_number]
+        return self.bitplanes[bitplane_number//self.number_of_channels, bitplane_number%self.number_of_channels]
+
+    # Adds a bitplane to the packet in construction, sending it
+    # before if the bitplane does not fit.
+    def send_bitplane(self, bitplane_number):
+        bitplane = self.get_bitplane(bitplane_number)
+        if self.packed_bytes + len(bitplane) > len(self.packet_payload):
+            self.send_packet()
+        self.packet_payload[self.packed_bytes:self.packed_bytes + len(bitplane)] = bitplane
+        self.packed_bytes += len(bitplane)
+        self.packed_bitmap |= 1 << bitplane_number
+        if self.is_coded(bitplane_number):
+            self.packed_coded_bitmap |= 1 << bitplane_number
+
+    def send_packet(self):
+        if self.packed_bitmap:
+            self.packet_header["chunk_number"] = self.recorded_chunk_number
+            self.packet_header["bitmap"] = self.packed_bitmap
+            if self.coder and self.coder.INDEPENDENT_REGIONS:
+                self.packet_header["coded_bitmap"] = self.packed_coded_bitmap
+            self.send_message(self.header_dtype.itemsize + self.packed_bytes)
+            self.packed_bytes = 0
+            self.packed_bitmap = 0
+            self.packed_coded_bitmap = 0
     
     def send(self, indata):
+        self.extract_bitplanes(indata)
         last_bitplane_to_send = 16*self.number_of_channels - self.number_of_bitplanes_to_send
-        for bitplane_number in range(31, last_bitplane_to_send, -1):
-            self.send_bitplane(indata, bitplane_number)
+        if self.coder:
+            self.encode_bitplanes(indata, range(16*self.number_of_channels-1, last_bitplane_to_send, -1))
+        for bitplane_number in range(16*self.number_of_channels-1, last_bitplane_to_send, -1):
+            self.send_bitplane(bitplane_number)
+        self.send_packet()
         self.recorded_chunk_number = (self.recorded_chunk_number + 1) % self.MAX_CHUNK_NUMBER
 
+    def run(self):
+        if self.coder and not self.coder.INDEPENDENT_REGIONS:
+            self.check_coder_speed()
+        Intercom_buffer.run(self)
+
+    def add_args(self):
+        parser = Intercom_buffer.add_args(self)
+        parser.add_argument("-cd", "--coder", help="Coding of the bitplanes: packed (packbits) or run-length coded when smaller (rice).", choices=["packbits", "rice"], default="packbits")
+        return parser
+
 if __name__ == "__main__":
     intercom = Intercom_bitplanes()
     parser = intercom.add_args()
@@ -2,50 +2,373 @@
 #
 # The buffer allows to reorder the chunks if they are not transmitted
 # in order by the network.
+#
+# Chunks larger than the MTU are splitted into fragments, each one in
+# a different packet, to avoid the IP fragmentation (where the loss
+# of a fragment implies the loss of the chunk). The lost fragments
+# are played as silence.
+#
+# With --codec, the payload of each packet is compressed with zlib,
+# LZMA or bzip2 (of the Python library), and sent compressed only if
+# it gets smaller. The "compressed" field of the header indicates
+# it. The byte of this field is taken from the MTU.
+#
+# With --pacing, the packets of each chunk are not sent back-to-back
+# (a burst that can overflow the shallow queues of routers and Wi-Fi
+# links) but spread over a fraction of the chunk period, by a Pacer
+# thread.
+#
+# With --latency_report, the time of each stage (the methods of
+# LATENCY_STAGES, and the audio callback) is recorded in latency
+# histograms (see latency_histograms.py), whose percentiles are shown
+# every latency_report seconds. The times are inclusive: for example,
+# reassembly includes the receive (unpack) of the packet.
+#
+# With --metrics (see Intercom), the received packets of chunks older
+# than the window of the buffer (the newest chunk received minus the
+# buffer depth) are counted as late, and the ones whose header has
+# been already received for the same chunk as duplicated. The chunks
+# played from a cell where no packet arrived are counted as empty.
 
-import sounddevice as sd
+try:
+    import sounddevice as sd
+except (ImportError, OSError):                                                  # No PortAudio: only usable offline (see test/loopback)
+    sd = None
 import numpy as np
-import struct
+import queue
+import sys
+import threading
+import zlib
+import lzma
+import bz2
+from time import perf_counter, sleep
 from intercom import Intercom
+from latency_histograms import Latency_histograms
 
-if __debug__:
-    import sys
+# Sends the packets of each burst (the packets of a chunk, which are
+# generated together) spread over a time, from its own thread. The
+# gap between packets is that time divided by the number of packets
+# of the previous burst. A new burst starts when a packet is sent
+# more than half a chunk period after the first packet of the
+# current one. The schedule of a burst never goes beyond its time:
+# if it has more packets than the previous one (for example, when
+# the rate controller increases NOBPTS), the packets that do not fit
+# are sent back-to-back at the end of it, instead of delaying the
+# next burst.
+class Pacer:
+
+    def __init__(self, sock, burst_time, chunk_period):
+        self.sock = sock
+        self.burst_time = burst_time
+        self.chunk_period = chunk_period
+        self.burst_start = -chunk_period
+        self.burst_packets = 0
+        self.gap = 0.0
+        self.packets = queue.SimpleQueue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # The message is copied, so its buffer can be reused.
+    def sendto(self, message, address):
+        now = perf_counter()
+        if now - self.burst_start > self.chunk_period/2:
+            self.gap = self.burst_time/max(self.burst_packets, 1)
+            self.burst_start = now
+            self.burst_packets = 0
+        self.packets.put((min(self.burst_start + self.burst_packets*self.gap, self.burst_start + self.burst_time), bytes(message), address))
+        self.burst_packets += 1
+
+    def run(self):
+        while True:
+            send_time, message, address = self.packets.get()
+            delay = send_time - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            self.sock.sendto(message, address)
 
 class Intercom_buffer(Intercom):
 
     MAX_CHUNK_NUMBER = 65536
+    IP_UDP_HEADERS_SIZE = 28
+    PIPELINE_DEPTH = 4                                                          # Slots of the pipeline rings
+    SILENCE_LEVEL = 128                                                         # Maximum amplitude of a silent chunk
+    LATENCY_STAGES = [("transform", "forward_transform"), ("extraction", "extract_bitplanes"), ("send", "send_message"), ("receive", "unpack"), ("reassembly", "buffer_message"), ("inverse_transform", "inverse_transform")]
 
     def init(self, args):
         Intercom.init(self, args)
         self.chunks_to_buffer = args.chunks_to_buffer
         self.cells_in_buffer = self.chunks_to_buffer * 2
-        #self._buffer = [self.generate_zero_chunk()] * self.cells_in_buffer
-        self._buffer = [None] * self.cells_in_buffer
-        for i in range(self.cells_in_buffer):
-            self._buffer[i] = self.generate_zero_chunk()
-        self.packet_format = f"!H{self.samples_per_chunk}h"
+        self.codec = None if args.codec == "none" else args.codec
+        self.codec_level = args.codec_level
+        if self.codec:
+            self.compress, self.decompress = self.get_codec(self.codec, self.codec_level)
+        # The buffer is a ring of cells stored in a single array, which
+        # is reused (cleared in place) after playing each cell.
+        self._buffer = np.zeros((self.cells_in_buffer, self.frames_per_chunk, self.number_of_channels), np.int16)
+        self.mtu = args.mtu
+        if self.codec:
+            self.mtu -= 1
+        header_dtype = np.dtype([("chunk_number", ">u2"), ("fragment_number", ">u2")])
+        self.samples_per_fragment = min(self.samples_per_chunk, (self.mtu - Intercom_buffer.IP_UDP_HEADERS_SIZE - header_dtype.itemsize)//np.dtype(np.int16).itemsize)
+        self.fragments_per_chunk = -(-self.samples_per_chunk//self.samples_per_fragment)
+        self.set_packet_format(header_dtype, ">i2", self.samples_per_fragment)
+
+        # Pipeline mode. The audio callback only copies the recorded
+        # chunk into input_ring and the played chunk from
+        # output_ring. The sender stage (a thread) encodes, sends and
+        # prepares the next chunk to play. This adds one chunk of
+        # playout delay. The slot of each callback is its number
+        # modulo PIPELINE_DEPTH, and the callback plays its output
+        # slot only if it was prepared for it (see
+        # prepared_callback_numbers), and silence otherwise (a late
+        # chunk). The sender stage drops the recorded chunks that are
+        # not the newest one (see sender_stage).
+        self.pipeline = args.pipeline
+        self.input_ring = np.zeros((Intercom_buffer.PIPELINE_DEPTH, self.frames_per_chunk, self.number_of_channels), np.int16)
+        self.output_ring = np.zeros((Intercom_buffer.PIPELINE_DEPTH, self.frames_per_chunk, self.number_of_channels), np.int16)
+        self.recorded_callback_numbers = queue.SimpleQueue()
+        self.callback_number = 0
+        self.prepared_callback_numbers = [0] + [-1]*(Intercom_buffer.PIPELINE_DEPTH - 1)  # The first callback plays silence
+        self.late_chunks = 0                                                    # Written by the callback
+        self.dropped_chunks = 0                                                 # Written by the sender stage
+        self.chunk_period = self.frames_per_chunk / self.frames_per_second
+        self.callback_times = np.zeros(max(1, int(1/self.chunk_period)))    # Around 1 second of callbacks
+        self.pacing = args.pacing
+        self.pacer = None
+        if self.pacing:
+            self.pacer = Pacer(self.sending_sock, self.pacing*self.chunk_period, self.chunk_period)
+
+        # The methods of the stages that the class has are replaced
+        # (in the instance) by timed versions.
+        self.latency_report = args.latency_report
+        self.latencies = None
+        if self.latency_report:
+            self.latencies = Latency_histograms()
+            for stage_name, method_name in Intercom_buffer.LATENCY_STAGES:
+                if hasattr(self, method_name):
+                    setattr(self, method_name, self.latencies.timed(stage_name, getattr(self, method_name)))
+            threading.Thread(target=self.report_latencies, daemon=True).start()
+
+        # Adaptive buffering. The transit time of each new chunk
+        # (arrival time minus the time at which it should have
+        # arrived, under a constant delay) is stored in a window of
+        # around 10 seconds. The target depth of the buffer is the
+        # jitter_percentile-th percentile of the variation of the
+        # transit time (in chunks), plus one. The playout depth is
+        # moved toward the target during silences.
+        self.adaptive_buffering = args.adaptive_buffering
+        self.jitter_percentile = args.jitter_percentile
+        self.chunks_per_second = max(1, int(1/self.chunk_period))
+        self.transit_times = np.zeros(self.chunks_per_second*10)
+        self.number_of_arrivals = 0
+        self.arrived_chunks = 0
+        self.last_arrived_chunk_number = None
+        self.jitter = 0.0
+        self.target_depth = self.chunks_to_buffer
+        self.buffer_depth = self.chunks_to_buffer
+        if self.metrics:
+            self.metrics.target_depth = self.target_depth
+            self.metrics.buffer_depth = self.buffer_depth
+
+        # Metrics of the received packets: the headers received for the
+        # chunk of each cell, the chunk (written only by the receiver),
+        # the chunk that each cell had when it was played (written
+        # only by the audio callback), and the newest chunk.
+        self.newest_chunk_number = None
+        self.received_headers = [set() for _ in range(self.cells_in_buffer)]
+        self.received_headers_chunk_number = [None]*self.cells_in_buffer
+        self.played_headers_chunk_number = [None]*self.cells_in_buffer
+
         if __debug__:
             print(f"chunks_to_buffer={self.chunks_to_buffer}")
+            print(f"fragments_per_chunk={self.fragments_per_chunk}")
+            print(f"codec={self.codec} codec_level={self.codec_level}")
+            print(f"pipeline={self.pipeline}")
+            print(f"pacing={self.pacing}")
+            print(f"latency_report={self.latency_report}")
+            print(f"adaptive_buffering={self.adaptive_buffering}")
+
+    # Packet codec. A packet is a header, described by a NumPy
+    # structured dtype, followed by a payload of payload_dtype
+    # items. The packet to send is built in a preallocated buffer
+    # through two views of it (packet_header and packet_payload), and
+    # the received packets are parsed with views of the received
+    # buffer. Therefore, (de)serializing a packet only requires to
+    # copy the payload (if it is not compressed).
+    def set_packet_format(self, header_dtype, payload_dtype, payload_size):
+        if self.codec:
+            header_dtype = np.dtype(header_dtype).descr + [("compressed", "u1")]
+        self.header_dtype = np.dtype(header_dtype)
+        self.payload_dtype = np.dtype(payload_dtype)
+        self.packet = bytearray(self.header_dtype.itemsize + payload_size*self.payload_dtype.itemsize)
+        self.packet_header = np.frombuffer(self.packet, self.header_dtype, 1)
+        self.packet_payload = np.frombuffer(self.packet, self.payload_dtype, payload_size, self.header_dtype.itemsize)
+
+    def unpack(self, message):
+        header = np.frombuffer(message, self.header_dtype, 1)[0]
+        if self.codec and header["compressed"]:
+            payload = np.frombuffer(self.decompress(message[self.header_dtype.itemsize:]), self.payload_dtype)
+        else:
+            payload = np.frombuffer(message, self.payload_dtype, -1, self.header_dtype.itemsize)
+        if self.metrics:
+            self.count_packet(header, message)
+        if self.adaptive_buffering:
+            self.track_arrival(int(header["chunk_number"]))
+        return header, payload
+
+    # Counts a received packet as late or duplicated or, else, stamps
+    # the cell of its chunk with the chunk number. A packet is late
+    # when its chunk is more than chunks_to_buffer chunks older than
+    # the newest one, because the chunks are never played later than
+    # that (the buffer depth, which -ab changes, is never deeper).
+    def count_packet(self, header, message):
+        chunk_number = int(header["chunk_number"])
+        if self.newest_chunk_number is None:
+            self.newest_chunk_number = chunk_number
+        age = (self.newest_chunk_number - chunk_number) % self.MAX_CHUNK_NUMBER
+        if age >= self.MAX_CHUNK_NUMBER//2:                                     # Newer
+            self.newest_chunk_number = chunk_number
+        elif age > self.chunks_to_buffer:
+            self.metrics.late_packets += 1
+            return
+        cell = chunk_number % self.cells_in_buffer
+        if self.received_headers_chunk_number[cell] != chunk_number:
+            self.received_headers[cell].clear()
+            self.received_headers_chunk_number[cell] = chunk_number
+        header_bytes = bytes(message[:self.header_dtype.itemsize])
+        if header_bytes in self.received_headers[cell]:
+            self.metrics.duplicate_packets += 1
+            return
+        self.received_headers[cell].add(header_bytes)
+
+    # Sends the first message_size bytes of the packet, compressing
+    # the payload if --codec, through the pacer if --pacing.
+    def send_message(self, message_size):
+        message = memoryview(self.packet)[:message_size]
+        if self.codec:
+            header_size = self.header_dtype.itemsize
+            payload = self.compress(message[header_size:])
+            self.packet_header["compressed"] = len(payload) < message_size - header_size
+            if self.packet_header["compressed"]:
+                message = message[:header_size].tobytes() + payload
+        if self.pacer:
+            self.pacer.sendto(message, (self.destination_IP_addr, self.destination_port))
+        else:
+            self.sending_sock.sendto(message, (self.destination_IP_addr, self.destination_port))
+        if self.metrics:
+            self.metrics.packets_sent += 1
+            self.metrics.bytes_sent += len(message)
 
-    def receive_and_buffer(self):
-        message, source_address = self.receiving_sock.recvfrom(Intercom.MAX_MESSAGE_SIZE)
-        chunk_number, *chunk = struct.unpack(self.packet_format, message)
-        self._buffer[chunk_number % self.cells_in_buffer] = np.asarray(chunk).reshape(self.frames_per_chunk, self.number_of_channels)
+    # Compression and decompression functions of a codec. LZMA is
+    # used without the .xz container (which adds tens of bytes), and
+    # with a dictionary of the size of the largest message (the
+    # presets allocate up to 64 MiB in each call).
+    @staticmethod
+    def get_codec(codec, level):
+        if codec == "zlib":
+            return (lambda data: zlib.compress(data, level)), zlib.decompress
+        if codec == "bz2":
+            return (lambda data: bz2.compress(data, max(level, 1))), bz2.decompress
+        filters = [{"id": lzma.FILTER_LZMA2, "preset": level, "dict_size": Intercom.MAX_MESSAGE_SIZE}]
+        return (lambda data: lzma.compress(data, lzma.FORMAT_RAW, filters=filters)), (lambda data: lzma.decompress(data, lzma.FORMAT_RAW, filters=filters))
+
+    # The fragment is copied directly into its position in the cell.
+    def buffer_message(self, message):
+        header, payload = self.unpack(message)
+        chunk_number = int(header["chunk_number"])
+        first_sample = int(header["fragment_number"])*self.samples_per_fragment
+        self._buffer[chunk_number % self.cells_in_buffer].reshape(-1)[first_sample:first_sample + len(payload)] = payload
         return chunk_number
 
+    # Tracks the arrival of a received packet of a chunk. The arrival
+    # time of every packet of a batch is the wakeup time of the
+    # receiver (see Intercom.receive_and_buffer), and not the time at
+    # which it is buffered, after the previous ones of the batch.
+    def track_arrival(self, chunk_number):
+        if self.last_arrived_chunk_number is None:
+            self.last_arrived_chunk_number = chunk_number
+        delta = (chunk_number - self.last_arrived_chunk_number) % self.MAX_CHUNK_NUMBER
+        if delta == 0 or delta >= self.MAX_CHUNK_NUMBER//2:                     # Already seen or older chunk
+            return
+        self.last_arrived_chunk_number = chunk_number
+        self.arrived_chunks += delta
+        self.transit_times[self.number_of_arrivals % len(self.transit_times)] = self.wakeup_time - self.arrived_chunks*self.chunk_period
+        self.number_of_arrivals += 1
+        if self.number_of_arrivals % self.chunks_per_second == 0:
+            self.update_target_depth()
+
+    def update_target_depth(self):
+        transit_times = self.transit_times[:min(self.number_of_arrivals, len(self.transit_times))]
+        self.jitter = np.percentile(transit_times - np.min(transit_times), self.jitter_percentile)
+        self.target_depth = min(int(np.ceil(self.jitter/self.chunk_period)) + 1, self.cells_in_buffer//2)
+        if self.metrics:
+            self.metrics.jitter_seconds = float(self.jitter)
+            self.metrics.target_depth = self.target_depth
+        if __debug__:
+            sys.stderr.write(f"\nbuffer_depth={self.buffer_depth} target_depth={self.target_depth} jitter(p{self.jitter_percentile:g})={self.jitter*1000:.1f} ms\n"); sys.stderr.flush()
+
+    # Called after playing a chunk (outdata). If the buffer is below
+    # the target depth, the played (and already cleared) cell is
+    # played again, inserting a silent chunk. If the buffer is above
+    # the target, the next chunk is dropped. Both things are done
+    # only after a silent chunk, except when the next chunk has not
+    # been received yet.
+    def adapt_playout(self, outdata):
+        if self.last_arrived_chunk_number is None:                               # Nothing received yet
+            return
+        self.buffer_depth = (self.last_arrived_chunk_number - self.played_chunk_number) % self.cells_in_buffer
+        if self.buffer_depth > self.cells_in_buffer//2:
+            self.buffer_depth -= self.cells_in_buffer
+        if self.metrics:
+            self.metrics.buffer_depth = self.buffer_depth
+        if self.buffer_depth < self.target_depth:
+            if self.buffer_depth < 0 or self.is_silent(outdata):
+                self.played_chunk_number = (self.played_chunk_number - 1) % self.cells_in_buffer
+        elif self.buffer_depth > self.target_depth + 1:
+            if self.is_silent(outdata):
+                self.clear_cell(self.played_chunk_number % self.cells_in_buffer)
+                self.played_chunk_number = (self.played_chunk_number + 1) % self.cells_in_buffer
+
+    # The samples are compared with the silence level without
+    # computing their absolute value, which for -32768 is -32768 in
+    # int16.
+    def is_silent(self, outdata):
+        return -self.SILENCE_LEVEL < outdata.min() and outdata.max() < self.SILENCE_LEVEL
+
+    # Resets the state of a cell that is not going to be played.
+    def clear_cell(self, cell):
+        self._buffer[cell].fill(0)
+
     def send(self, indata):
-        message = struct.pack(self.packet_format, self.recorded_chunk_number, *(indata.flatten()))
+        samples = indata.reshape(-1)
+        self.packet_header["chunk_number"] = self.recorded_chunk_number
+        for fragment_number in range(self.fragments_per_chunk):
+            fragment = samples[fragment_number*self.samples_per_fragment:(fragment_number + 1)*self.samples_per_fragment]
+            self.packet_header["fragment_number"] = fragment_number
+            self.packet_payload[:len(fragment)] = fragment
+            self.send_message(self.header_dtype.itemsize + fragment.nbytes)
         self.recorded_chunk_number = (self.recorded_chunk_number + 1) % self.MAX_CHUNK_NUMBER
-        self.sending_sock.sendto(message, (self.destination_IP_addr, self.destination_port))
+
+    # A played cell is empty if no packet of a new chunk has stamped
+    # it since it was played before.
+    def count_played_cell(self, cell):
+        self.metrics.chunks_played += 1
+        chunk_number = self.received_headers_chunk_number[cell]
+        if chunk_number is None or chunk_number == self.played_headers_chunk_number[cell]:
+            self.metrics.empty_chunks_played += 1
+        self.played_headers_chunk_number[cell] = chunk_number
 
     def feedback(self):
         sys.stderr.write("."); sys.stderr.flush()
 
     def play(self, outdata):
         chunk = self._buffer[self.played_chunk_number % self.cells_in_buffer]
-        self._buffer[self.played_chunk_number % self.cells_in_buffer] = self.generate_zero_chunk()
-        self.played_chunk_number = (self.played_chunk_number + 1) % self.cells_in_buffer
         outdata[:] = chunk
+        chunk.fill(0)
+        if self.metrics:
+            self.count_played_cell(self.played_chunk_number % self.cells_in_buffer)
+        self.played_chunk_number = (self.played_chunk_number + 1) % self.cells_in_buffer
+        if self.adaptive_buffering:
+            self.adapt_playout(outdata)
         if __debug__:
             self.feedback()
 
@@ -53,10 +376,81 @@ class Intercom_buffer(Intercom):
         self.send(indata)
         self.play(outdata)
 
+    # Audio callback in pipeline mode. It never blocks: the chunk
+    # played now was prepared by the sender stage while the previous
+    # callback period elapsed. If it was not (the sender stage is
+    # late, and could be writing the slot), silence is played.
+    def record_and_play(self, indata, outdata, frames, time, status):
+        start = perf_counter()
+        slot = self.callback_number % Intercom_buffer.PIPELINE_DEPTH
+        self.input_ring[slot] = indata
+        if self.prepared_callback_numbers[slot] == self.callback_number:
+            outdata[:] = self.output_ring[slot]
+        else:
+            outdata.fill(0)
+            self.late_chunks += 1
+            if self.metrics:
+                self.metrics.pipeline_late_chunks += 1
+        self.recorded_callback_numbers.put(self.callback_number)
+        self.callback_times[self.callback_number % len(self.callback_times)] = perf_counter() - start
+        self.callback_number += 1
+
+    # Runs, out of the audio callback, the record_send_and_play of
+    # the class for each recorded chunk. The generated chunk will be
+    # played in the next callback. A chunk is stale if a newer one has
+    # been recorded: the next callback has already played (silence),
+    # and its input slot will be overwritten, so it is dropped (see
+    # drop_chunk) to catch up. The callback times, the late and the
+    # dropped chunks are reported every second of chunks taken by the
+    # stage.
+    def sender_stage(self, record_send_and_play):
+        taken_chunks = 0
+        while True:
+            callback_number = self.recorded_callback_numbers.get()
+            if callback_number < self.callback_number - 1:
+                self.drop_chunk()
+            else:
+                slot = callback_number % Intercom_buffer.PIPELINE_DEPTH
+                next_slot = (callback_number + 1) % Intercom_buffer.PIPELINE_DEPTH
+                record_send_and_play(self.input_ring[slot], self.output_ring[next_slot], self.frames_per_chunk, None, None)
+                self.prepared_callback_numbers[next_slot] = callback_number + 1
+            taken_chunks += 1
+            if taken_chunks % len(self.callback_times) == 0:
+                self.report_callback_times()
+
+    # Skips a recorded chunk (that is not sent, so the interlocutor
+    # sees it as lost) and the chunk of the buffer that it would have
+    # played (as adapt_playout drops a chunk).
+    def drop_chunk(self):
+        self.recorded_chunk_number = (self.recorded_chunk_number + 1) % self.MAX_CHUNK_NUMBER
+        self.clear_cell(self.played_chunk_number % self.cells_in_buffer)
+        self.played_chunk_number = (self.played_chunk_number + 1) % self.cells_in_buffer
+        self.dropped_chunks += 1
+        if self.metrics:
+            self.metrics.pipeline_dropped_chunks += 1
+
+    def report_callback_times(self):
+        sys.stderr.write(f"\ncallback time: avg={np.mean(self.callback_times)*1e6:.1f} max={np.max(self.callback_times)*1e6:.1f} period={self.chunk_period*1e6:.1f} (us) late_chunks={self.late_chunks} dropped_chunks={self.dropped_chunks}\n"); sys.stderr.flush()
+
+    def report_latencies(self):
+        while True:
+            sleep(self.latency_report)
+            report = self.latencies.report()
+            if report:
+                print(report, flush=True)
+
     def run(self):
         self.recorded_chunk_number = 0
         self.played_chunk_number = 0
-        with sd.Stream(samplerate=self.frames_per_second, blocksize=self.frames_per_chunk, dtype=np.int16, channels=self.number_of_channels, callback=self.record_send_and_play):
+        callback = self.record_send_and_play
+        if self.pipeline:
+            threading.Thread(target=self.sender_stage, args=(self.record_send_and_play,), daemon=True).start()
+            callback = self.record_and_play
+        if self.latencies:
+            callback = self.latencies.timed_callback(callback)
+        if self.metrics:
+            callback = self.metrics.counted_callback(callback)
+        with sd.Stream(samplerate=self.frames_per_second, blocksize=self.frames_per_chunk, dtype=np.int16, channels=self.number_of_channels, callback=callback):
             print("-=- Press CTRL + c to quit -=-")
             first_received_chunk_number = self.receive_and_buffer()
             self.played_chunk_number = (first_received_chunk_number - self.chunks_to_buffer) % self.cells_in_buffer
@@ -66,6 +460,14 @@ class Intercom_buffer(Intercom):
     def add_args(self):
         parser = Intercom.add_args(self)
         parser.add_argument("-cb", "--chunks_to_buffer", help="Number of chunks to buffer", type=int, default=32)
+        parser.add_argument("-mtu", "--mtu", help="Maximum Transmission Unit (in bytes) of the path (IP and UDP headers included).", type=int, default=1500)
+        parser.add_argument("-pl", "--pipeline", help="Encode and send out of the audio callback.", action="store_true")
+        parser.add_argument("-pc", "--pacing", help="Fraction of the chunk period over which the packets of a chunk are spread (0 = no pacing).", type=float, default=0)
+        parser.add_argument("-ab", "--adaptive_buffering", help="Adapt the number of buffered chunks to the network jitter.", action="store_true")
+        parser.add_argument("-co", "--codec", help="Compressor of the payloads.", type=str, choices=["none", "zlib", "lzma", "bz2"], default="none")
+        parser.add_argument("-cl", "--codec_level", help="Compression level (0-9) of --codec.", type=int, default=6)
+        parser.add_argument("-lr", "--latency_report", help="Seconds between the reports of the latencies of the stages (0 = no instrumentation).", type=float, default=0)
+        parser.add_argument("-jp", "--jitter_percentile", help="Percentile of the jitter covered by the buffer in adaptive buffering.", type=float, default=95)
         return parser
 
 if __name__ == "__main__":
@@ -6,56 +6,258 @@
 # filter the fast changes in the link bandwidth. Sign-magnitude
 # representation is used to minimize the distortion of the partially
 # received negative samples.
+#
+# The number of bitplanes to send is decided by a rate controller
+# (see rate_controllers.py): by default (--rate_controller ewma), the
+# weighted average of the received bitplanes plus one. With
+# --rate_controller delay, the packets also carry the time at which
+# they were sent and, back, the queuing delay measured by the
+# receiver, and the controller keeps that delay under a target.
+#
+# Every --report_interval played chunks, the receiver also sends a
+# receiver report (as RTCP), a packet with an empty bitmap whose
+# payload has (see REPORT_DTYPE) the number of received bitplanes of
+# each played chunk, identified by its chunk number, the runs of
+# chunks not received at all, the arrival jitter (as in RTCP) and the
+# depth of the buffer, followed by the received bitplanes of each
+# chunk (>u2). The sender knows how many bitplanes it sent of each
+# chunk, so the rate controller gets the exact feedback of the last
+# reported chunk instead of NORB (which is of the chunk played by
+# the receiver when the packet is sent).
+#
+# With --metrics (see Intercom), each NOBPTS and the NORB that
+# produced it are recorded, and the receiver reports are not counted
+# as packets of chunks.
 
-import struct
+import time
 import numpy as np
 from intercom import Intercom
 from intercom_binaural import Intercom_binaural
+from rate_controllers import EWMA_controller, Delay_controller, Queuing_delay_estimator
 
 if __debug__:
     import sys
 
 class Intercom_DFC(Intercom_binaural):
 
+    REPORT_DTYPE = np.dtype([("first_chunk_number", ">u2"), ("loss_runs", "u1"), ("longest_loss_run", "u1"), ("jitter", ">u2"), ("buffer_depth", ">i2")])  # Jitter in 1/10 ms, and depth in chunks
+
     def init(self, args):
         Intercom_binaural.init(self, args)
-        self.packet_format = f"!HBB{self.frames_per_chunk//8}B"
+        if args.rate_controller == "delay":
+            self.rate_controller = Delay_controller()
+        else:
+            self.rate_controller = EWMA_controller()
+        self.set_bitplanes_packet_format([("chunk_number", ">u2"), ("bitmap", ">u8"), ("NORB", "u1")] + self.rate_controller.HEADER_FIELDS)
         self.received_bitplanes_per_chunk = [0]*self.cells_in_buffer
+        self.sent_bitplanes_per_chunk = [0]*self.cells_in_buffer
+        self.sent_chunk_numbers = [None]*self.cells_in_buffer
+        self.transmitted_bitplanes_per_chunk = [0]*self.cells_in_buffer  # The non-empty ones
         self.max_NOBPTS = 16*self.number_of_channels  # Maximum Number Of Bitplanes To Send
         self.NOBPTS = self.max_NOBPTS
         self.NORB = self.max_NOBPTS  # Number Of Received Bitplanes
+        self.delay_estimator = Queuing_delay_estimator()
+        self.reported_queuing_delay = None  # Of the sent packets, fed back by the receiver
+
+        # Receiver reports
+        self.report_interval = args.report_interval
+        self.arrived_bitplanes_per_chunk = [0]*self.cells_in_buffer
+        self.arrived_chunk_numbers = [0]*self.cells_in_buffer
+        self.played_chunk_numbers = []  # Since the last report
+        self.played_bitplanes = []
+        self.last_played_chunk_number = None
+        self.latest_chunk_number = None
+        self.latest_arrival_time = 0.0
+        self.arrival_jitter = 0.0  # In seconds
+        self.report = None  # The last one received, and its bitplanes
+        self.reported_bitplanes = None
+        self.report_feedback = None  # (NORB, skipped, sent) of the last report, until it is used
+        self.last_reported_chunk_number = None  # The next one to the last reported chunk
+
+        if __debug__:
+            print(f"rate_controller={type(self.rate_controller).__name__}")
+            print(f"report_interval={self.report_interval}")
+
+    # Time, in milliseconds, for the timestamps of the packets.
+    def get_timestamp(self):
+        return int(time.time()*1000) & 0xFFFFFFFF
+
+    # With a FEEDBACK controller, measures the queuing delay of the
+    # received packet and takes the one reported of the sent packets.
+    # The arrivals of the bitplanes of each chunk, and the jitter of
+    # the first one, are recorded for the receiver reports.
+    def unpack(self, message):
+        header, payload = Intercom_binaural.unpack(self, message)
+        if self.rate_controller.FEEDBACK:
+            one_way_delay = ((self.get_timestamp() - int(header["timestamp"]) + (1 << 31)) & 0xFFFFFFFF) - (1 << 31)
+            self.delay_estimator.update(one_way_delay/1000, time.monotonic())
+            self.reported_queuing_delay = int(header["queuing_delay"])/1000
+        bitmap = int(header["bitmap"])
+        if self.report_interval and bitmap:
+            chunk_number = int(header["chunk_number"])
+            self.arrived_bitplanes_per_chunk[chunk_number % self.cells_in_buffer] += bin(bitmap).count("1")
+            self.arrived_chunk_numbers[chunk_number % self.cells_in_buffer] = chunk_number
+            if chunk_number != self.latest_chunk_number:
+                self.track_jitter(chunk_number)
+        return header, payload
+
+    # The receiver reports are not packets of chunks.
+    def count_packet(self, header, message):
+        if header["bitmap"]:
+            Intercom_binaural.count_packet(self, header, message)
+
+    # Interarrival jitter of RFC 3550, with the first packet of each
+    # chunk (which should arrive a chunk period after the previous
+    # one).
+    def track_jitter(self, chunk_number):
+        now = time.monotonic()
+        if self.latest_chunk_number is not None:
+            chunks = (chunk_number - self.latest_chunk_number) % self.MAX_CHUNK_NUMBER
+            if chunks >= self.MAX_CHUNK_NUMBER//2:  # Reordered
+                return
+            difference = (now - self.latest_arrival_time) - chunks*self.chunk_period
+            self.arrival_jitter += (abs(difference) - self.arrival_jitter)/16
+            if self.metrics:
+                self.metrics.arrival_jitter_seconds = self.arrival_jitter
+        self.latest_chunk_number = chunk_number
+        self.latest_arrival_time = now
 
-    def receive_and_buffer(self):
-        message, source_address = self.receiving_sock.recvfrom(Intercom.MAX_MESSAGE_SIZE)
-        received_chunk_number, received_bitplane_number, self.NORB, *bitplane = struct.unpack(self.packet_format, message)
-        bitplane = np.asarray(bitplane, dtype=np.uint8)
-        bitplane = np.unpackbits(bitplane)
-        bitplane = bitplane.astype(np.uint16)
-        self._buffer[received_chunk_number % self.cells_in_buffer][:, received_bitplane_number%self.number_of_channels] |= (bitplane << received_bitplane_number//self.number_of_channels)
-        self.received_bitplanes_per_chunk[received_chunk_number % self.cells_in_buffer] += 1
+    # Asks the rate controller the NOBPTS of the chunk to send. The
+    # feedback is the one of a new receiver report (used only once) or,
+    # between reports (and without them), NORB, which is considered to
+    # be of the chunk that will be played next, as skipped_bitplanes.
+    def update_NOBPTS(self, skipped_bitplanes=0):
+        report_feedback, self.report_feedback = self.report_feedback, None   # Written by the receiver
+        if report_feedback:
+            NORB, skipped_bitplanes, sent = report_feedback
+        else:
+            NORB, sent = self.NORB, self.sent_bitplanes_per_chunk[(self.played_chunk_number+1) % self.cells_in_buffer]
+        self.NOBPTS = self.rate_controller.get_NOBPTS(self.NOBPTS, self.max_NOBPTS, NORB, skipped_bitplanes, sent, self.reported_queuing_delay)
+        if self.metrics:
+            self.metrics.record_NOBPTS(self.NOBPTS, NORB)
+        cell = self.recorded_chunk_number % self.cells_in_buffer
+        self.sent_bitplanes_per_chunk[cell] = self.NOBPTS
+        self.sent_chunk_numbers[cell] = self.recorded_chunk_number
+        self.transmitted_bitplanes_per_chunk[cell] = 0
+
+    # Records the received bitplanes of the chunk to play (which is
+    # identified by the chunk number of its packets or, if none has
+    # arrived, as the next one), and sends a report every
+    # report_interval chunks (or before, if the played chunks are not
+    # consecutive).
+    def play(self, outdata):
+        if self.report_interval:
+            cell = self.played_chunk_number % self.cells_in_buffer
+            if self.arrived_bitplanes_per_chunk[cell]:
+                chunk_number = self.arrived_chunk_numbers[cell]
+            elif self.last_played_chunk_number is not None:
+                chunk_number = (self.last_played_chunk_number + 1) % self.MAX_CHUNK_NUMBER
+            else:
+                chunk_number = None
+            if chunk_number is not None:
+                if self.played_chunk_numbers and chunk_number != (self.played_chunk_numbers[-1] + 1) % self.MAX_CHUNK_NUMBER:
+                    self.send_report()
+                self.played_chunk_numbers.append(chunk_number)
+                self.played_bitplanes.append(self.arrived_bitplanes_per_chunk[cell])
+                if len(self.played_chunk_numbers) >= min(self.report_interval, self.get_max_report_length()):
+                    self.send_report()
+            self.last_played_chunk_number = chunk_number
+            self.arrived_bitplanes_per_chunk[cell] = 0
+        Intercom_binaural.play(self, outdata)
+
+    # The played chunks that fit in the payload of a report.
+    def get_max_report_length(self):
+        return (len(self.packet_payload) - self.REPORT_DTYPE.itemsize)//np.dtype(">u2").itemsize
+
+    def send_report(self):
+        report = np.zeros(1, self.REPORT_DTYPE)
+        report["first_chunk_number"] = self.played_chunk_numbers[0]
+        lost = np.array(self.played_bitplanes) == 0
+        run_starts = np.flatnonzero(np.diff(lost.astype(np.int8), prepend=0) == 1)
+        run_ends = np.flatnonzero(np.diff(lost.astype(np.int8), append=0) == -1)
+        report["loss_runs"] = min(len(run_starts), 0xFF)
+        report["longest_loss_run"] = min(np.max(run_ends - run_starts + 1, initial=0), 0xFF)
+        report["jitter"] = min(int(self.arrival_jitter*10000), 0xFFFF)
+        if self.latest_chunk_number is not None:
+            depth = (self.latest_chunk_number - self.played_chunk_numbers[-1]) % self.MAX_CHUNK_NUMBER
+            report["buffer_depth"] = depth if depth < self.MAX_CHUNK_NUMBER//2 else depth - self.MAX_CHUNK_NUMBER
+        report = report.tobytes() + np.array(self.played_bitplanes, dtype=">u2").tobytes()
+        self.packet_payload[:len(report)] = np.frombuffer(report, np.uint8)
+        self.packet_header["chunk_number"] = (self.recorded_chunk_number - 1) % self.MAX_CHUNK_NUMBER
+        self.packet_header["bitmap"] = 0
+        self.set_feedback_fields()
+        self.send_message(self.header_dtype.itemsize + len(report))
+        self.played_chunk_numbers = []
+        self.played_bitplanes = []
+
+    # Aggregates the feedback of the chunks of the report that are
+    # newer than the ones of the previous reports and still known by
+    # the sender: the averages of NORB, of the skipped bitplanes and of
+    # the sent ones (rounded, so the loss that they give is the one of
+    # all those chunks). Returns the chunk number in the header of the
+    # report packet (the last one sent by the receiver, already seen).
+    def receive_report(self, header, payload):
+        self.report = np.frombuffer(payload, self.REPORT_DTYPE, 1)[0]
+        self.reported_bitplanes = np.frombuffer(payload, ">u2", -1, self.REPORT_DTYPE.itemsize)
+        first_chunk_number = int(self.report["first_chunk_number"])
+        received = skipped = sent = number_of_chunks = 0
+        for i in range(len(self.reported_bitplanes)):
+            chunk_number = (first_chunk_number + i) % self.MAX_CHUNK_NUMBER
+            if self.last_reported_chunk_number is not None and (chunk_number - self.last_reported_chunk_number) % self.MAX_CHUNK_NUMBER >= self.MAX_CHUNK_NUMBER//2:
+                continue                                                        # Already reported
+            cell = chunk_number % self.cells_in_buffer
+            if self.sent_chunk_numbers[cell] == chunk_number:
+                received += int(self.reported_bitplanes[i])
+                skipped += max(self.sent_bitplanes_per_chunk[cell] - self.transmitted_bitplanes_per_chunk[cell], 0)
+                sent += self.sent_bitplanes_per_chunk[cell]
+                number_of_chunks += 1
+            self.last_reported_chunk_number = (chunk_number + 1) % self.MAX_CHUNK_NUMBER
+        if number_of_chunks:
+            self.report_feedback = (round(received/number_of_chunks) + 1, round(skipped/number_of_chunks), round(sent/number_of_chunks))
+        return int(header["chunk_number"])
+
+    def buffer_message(self, message):
+        header, payload = self.unpack(message)
+        if header["bitmap"] == 0:
+            return self.receive_report(header, payload)
+        received_chunk_number = int(header["chunk_number"])
+        self.NORB = int(header["NORB"])
+        self.received_bitplanes_per_chunk[received_chunk_number % self.cells_in_buffer] += self.buffer_bitplanes(received_chunk_number, int(header["bitmap"]), payload, self.get_coded_bitmap(header))
         return received_chunk_number
 
-    def send_bitplane(self, indata, bitplane_number):
-        bitplane = (indata[:, bitplane_number%self.number_of_channels] >> bitplane_number//self.number_of_channels) & 1
-        bitplane = bitplane.astype(np.uint8)
-        bitplane = np.packbits(bitplane)
-        message = struct.pack(self.packet_format, self.recorded_chunk_number, bitplane_number, self.received_bitplanes_per_chunk[(self.played_chunk_number+1) % self.cells_in_buffer]+1, *bitplane)
-        self.sending_sock.sendto(message, (self.destination_IP_addr, self.destination_port))
+    def clear_cell(self, cell):
+        Intercom_binaural.clear_cell(self, cell)
+        self.received_bitplanes_per_chunk[cell] = 0
+
+    def get_number_of_regions(self):
+        return self.max_NOBPTS
+
+    def set_feedback_fields(self):
+        self.packet_header["NORB"] = self.received_bitplanes_per_chunk[(self.played_chunk_number+1) % self.cells_in_buffer]+1
+        if self.rate_controller.FEEDBACK:
+            self.packet_header["timestamp"] = self.get_timestamp()
+            self.packet_header["queuing_delay"] = min(max(int((self.delay_estimator.queuing_delay or 0)*1000), 0), 0xFFFF)
+
+    def send_packet(self):
+        self.set_feedback_fields()
+        self.transmitted_bitplanes_per_chunk[self.recorded_chunk_number % self.cells_in_buffer] += bin(self.packed_bitmap).count("1")
+        Intercom_binaural.send_packet(self)
     
     def send(self, indata):
         signs = indata & 0x8000
         magnitudes = abs(indata)
         indata = signs | magnitudes
+        self.extract_bitplanes(indata)
         
-        self.NOBPTS = int(0.75*self.NOBPTS + 0.25*self.NORB)
-        self.NOBPTS += 1
-        if self.NOBPTS > self.max_NOBPTS:
-            self.NOBPTS = self.max_NOBPTS
+        self.update_NOBPTS()
         last_BPTS = self.max_NOBPTS - self.NOBPTS - 1
-        self.send_bitplane(indata, self.max_NOBPTS-1)
-        self.send_bitplane(indata, self.max_NOBPTS-2)
+        if self.coder:
+            self.encode_bitplanes(indata, range(self.max_NOBPTS-1, min(last_BPTS, self.max_NOBPTS-3), -1))
+        self.send_bitplane(self.max_NOBPTS-1)
+        self.send_bitplane(self.max_NOBPTS-2)
         for bitplane_number in range(self.max_NOBPTS-3, last_BPTS, -1):
-            self.send_bitplane(indata, bitplane_number)
+            self.send_bitplane(bitplane_number)
+        self.send_packet()
         self.recorded_chunk_number = (self.recorded_chunk_number + 1) % self.MAX_CHUNK_NUMBER
 
     def record_send_and_play_stereo(self, indata, outdata, frames, time, status):
@@ -84,6 +286,12 @@ class Intercom_DFC(Intercom_binaural):
         self.received_bitplanes_per_chunk [self.played_chunk_number % self.cells_in_buffer] = 0
         #print(*self.received_bitplanes_per_chunk)
 
+    def add_args(self):
+        parser = Intercom_binaural.add_args(self)
+        parser.add_argument("-ri", "--report_interval", help="Played chunks described by each receiver report (0 = no reports).", type=int, default=8)
+        parser.add_argument("-rc", "--rate_controller", help="Controller of the number of bitplanes to send: weighted average of the received ones (ewma) or delay-based (delay).", choices=["ewma", "delay"], default="ewma")
+        return parser
+
 if __name__ == "__main__":
     intercom = Intercom_DFC()
     parser = intercom.add_args()
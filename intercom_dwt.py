@@ -68,8 +68,12 @@
 # samples larger than the number of coefficients of the Wavelet
 # filters, we don't need to be aware of this detail if we work with
 # chunks.
+#
+# This is done when --overlap is used (see Overlapped_DWT). The
+# chunk i is transformed when the chunk i+1 has been recorded, and
+# it is reconstructed when the coefficients of the chunk i+1 have
+# been received. Therefore, 2 chunks of latency are added.
 
-import struct
 import numpy as np
 import pywt
 from intercom import Intercom
@@ -88,10 +92,198 @@ factor = 10
 if __debug__:
     import sys
 
+# Reversible integer-to-integer DWT (Haar or LeGall 5/3 filters)
+# computed with the lifting scheme. All the channels are transformed
+# at once and in place, on int32 (frames, channels) arrays, using
+# periodic extension (frames must be a multiple of 2**levels). The
+# coefficients are placed as pywt.coeffs_to_array does:
+# [L_levels, H_levels, ..., H_1]. With 16-bit samples, the
+# coefficients fit in 18 bits (sign and 17 magnitude bits).
+class Lifting_DWT:
+
+    BITS_PER_COEFFICIENT = 18
+    FILTER_LENGTH = {"haar": 2, "legall53": 5}
+
+    def __init__(self, wavelet, frames, channels, levels):
+        self.wavelet = wavelet
+        self.levels = levels
+        self.interleaved = np.empty((frames, channels), np.int32)
+        self.neighbours = np.empty((frames//2, channels), np.int32)
+
+    # neighbours[i] = x[i] + x[i+1] (shift=1) or x[i-1] + x[i] (shift=-1)
+    def add_neighbours(self, x, shift):
+        neighbours = self.neighbours[:len(x)]
+        if shift == 1:
+            np.add(x[:-1], x[1:], out=neighbours[:-1])
+            np.add(x[-1], x[0], out=neighbours[-1])
+        else:
+            np.add(x[:-1], x[1:], out=neighbours[1:])
+            np.add(x[-1], x[0], out=neighbours[0])
+        return neighbours
+
+    def forward(self, chunk, coeffs):
+        coeffs[:] = chunk
+        length = len(coeffs)
+        for l in range(self.levels):
+            even = coeffs[0:length:2]
+            odd = coeffs[1:length:2]
+            if self.wavelet == "haar":
+                odd -= even
+                even += odd >> 1
+            else:
+                odd -= self.add_neighbours(even, 1) >> 1
+                neighbours = self.add_neighbours(odd, -1)
+                neighbours += 2
+                even += neighbours >> 2
+            self.interleaved[:length//2] = even
+            self.interleaved[length//2:length] = odd
+            coeffs[:length] = self.interleaved[:length]
+            length //= 2
+        return coeffs
+
+    def inverse(self, coeffs, chunk):
+        chunk[:] = coeffs
+        for l in range(self.levels-1, -1, -1):
+            length = len(chunk) >> l
+            self.interleaved[0:length:2] = chunk[:length//2]
+            self.interleaved[1:length:2] = chunk[length//2:length]
+            chunk[:length] = self.interleaved[:length]
+            even = chunk[0:length:2]
+            odd = chunk[1:length:2]
+            if self.wavelet == "haar":
+                even -= odd >> 1
+                odd += even
+            else:
+                neighbours = self.add_neighbours(odd, -1)
+                neighbours += 2
+                even -= neighbours >> 2
+                odd += self.add_neighbours(even, 1) >> 1
+        return chunk
+
+# Floating-point DWT of chunks of a fixed size. The wavelet filters
+# and the position of each subband in the array of coefficients
+# (coeff_slices, as returned by pywt.coeffs_to_array) are computed
+# once. The (frames, channels) chunks are transposed into a
+# preallocated buffer, because the 1-D transform of a contiguous
+# channel is faster than the N-D transform of all of them. The
+# coefficients and the samples are left in preallocated float64
+# (frames, channels) buffers, unless other output array is given.
+class Wavelet_plan:
+
+    def __init__(self, wavelet, padding, levels, coeff_slices, frames, channels):
+        self.wavelet = pywt.Wavelet(wavelet)
+        self.padding = padding
+        self.approximation = coeff_slices[0][0]
+        #Details from the finest (H_1) to the coarsest (H_levels) subband
+        self.details = [slices["d"][0] for slices in coeff_slices[:0:-1]]
+        assert len(self.details) == levels
+        self.channels = np.zeros((channels, frames), dtype=np.float64)
+        self.coeffs = np.zeros((frames, channels), dtype=np.float64)
+        self.samples = np.zeros((frames, channels), dtype=np.float64)
+
+    def forward(self, chunk, out=None):
+        if out is None:
+            out = self.coeffs
+        np.copyto(self.channels, chunk.T)
+        for channel, approximation in enumerate(self.channels):
+            for details in self.details:
+                approximation, out[details, channel] = pywt.dwt(approximation, self.wavelet, mode=self.padding)
+            out[self.approximation, channel] = approximation
+        return out
+
+    def inverse(self, coeffs, out=None):
+        if out is None:
+            out = self.samples
+        np.copyto(self.channels, coeffs.T)
+        for channel, coeffs in enumerate(self.channels):
+            approximation = coeffs[self.approximation]
+            for details in reversed(self.details):
+                approximation = pywt.idwt(approximation, coeffs[details], self.wavelet, mode=self.padding)
+            out[:, channel] = approximation
+        return out
+
+# Overlapped DWT. The chunk i is transformed (using a DWT of
+# frames+2*overlap samples) together with the last "overlap" samples
+# of the chunk i-1 and the first "overlap" samples of the chunk i+1,
+# and only the coefficients that belong to the chunk i are kept
+# (frames coefficients, placed as in the non-overlapped DWT). To
+# reconstruct the chunk i, the subbands of the chunk i are extended
+# with the coefficients of the chunks i-1 and i+1 in the same way.
+#
+# The overlap is the number of samples that the filters propagate
+# across the border of a chunk, (filter_length-1)*(2**levels-1),
+# rounded up to a multiple of 2**levels to keep the subbands aligned.
+class Overlapped_DWT:
+
+    @staticmethod
+    def get_overlap(filter_length, levels):
+        return -(-(filter_length - 1)*(2**levels - 1) // 2**levels) * 2**levels
+
+    def __init__(self, dwt, overlap, levels, frames, channels, dtype):
+        self.dwt = dwt
+        self.overlap = overlap
+        assert overlap % 2**levels == 0 and 0 < overlap <= frames
+        self.frames = frames
+        extended_frames = frames + 2*overlap
+
+        #The chunks i-1 (only its last samples) and i, and the chunk i+1 (only its first samples)
+        self.history = np.zeros((overlap + frames, channels), dtype=dtype)
+        self.extended_chunk = np.zeros((extended_frames, channels), dtype=dtype)
+        self.extended_coeffs = np.zeros((extended_frames, channels), dtype=dtype)
+        self.coeffs = np.zeros((frames, channels), dtype=dtype)
+        self.samples = np.zeros((frames, channels), dtype=dtype)
+        self.received_coeffs = np.zeros((extended_frames, channels), dtype=np.int32)
+
+        #For each coefficient of a chunk, its position in the extended coefficients, and for each
+        #extended coefficient, the chunk (-1, 0 or 1) and the position of the coefficient in that chunk
+        self.center = np.empty(frames, dtype=np.intp)
+        self.window_chunks = np.empty(extended_frames, dtype=np.intp)
+        self.window_positions = np.empty(extended_frames, dtype=np.intp)
+        self.rows = np.empty(extended_frames, dtype=np.intp)
+        start, extended_start = 0, 0
+        for l in [levels] + list(range(levels, 0, -1)):
+            length, extra = frames >> l, overlap >> l
+            subband = np.arange(start, start + length)
+            self.center[start:start + length] = np.arange(extended_start + extra, extended_start + extra + length)
+            self.window_chunks[extended_start:extended_start + length + 2*extra] = [-1]*extra + [0]*length + [1]*extra
+            self.window_positions[extended_start:extended_start + length + 2*extra] = np.concatenate((subband[length - extra:], subband, subband[:extra]))
+            start += length
+            extended_start += length + 2*extra
+
+    #Returns the coefficients of the previous chunk
+    def forward(self, chunk, out=None):
+        if out is None:
+            out = self.coeffs
+        self.extended_chunk[:-self.overlap] = self.history
+        self.extended_chunk[-self.overlap:] = chunk[:self.overlap]
+        self.history[:self.overlap] = self.history[self.frames:]
+        self.history[self.overlap:] = chunk
+        coeffs = self.dwt.forward(self.extended_chunk, self.extended_coeffs)
+        np.take(coeffs, self.center, axis=0, out=out)
+        return out
+
+    #Returns the coefficients of the cell of a ring of chunks of (int32)
+    #coefficients, extended with the ones of the adjacent cells
+    def window(self, cells, cell):
+        np.add(self.window_chunks, cell, out=self.rows)
+        self.rows %= len(cells)
+        self.rows *= self.frames
+        self.rows += self.window_positions
+        return np.take(cells.reshape(len(cells)*self.frames, -1), self.rows, axis=0, out=self.received_coeffs)
+
+    #The coeffs are the ones returned by window()
+    def inverse(self, coeffs, out=None):
+        if out is None:
+            out = self.samples
+        samples = self.dwt.inverse(coeffs, self.extended_chunk)
+        np.copyto(out, samples[self.overlap:-self.overlap], casting="unsafe")
+        return out
+
 class Intercom_DWT(Intercom_empty):
 
     def init(self, args):
         Intercom_empty.init(self, args)
+        self.transform = args.transform
 
         #We increase the number of bitplanes to send to 32 per channel
         self.max_NOBPTS = 32*self.number_of_channels
@@ -102,77 +294,154 @@ class Intercom_DWT(Intercom_empty):
         coeff_temp, self.coeff_slices = pywt.coeffs_to_array(self.coeffs)
 
         #We create the buffers to store the coefficients in their correct format
-        self.buffer_send = np.zeros((len(coeff_temp), 2), dtype=np.int32)
+        self.buffer_send = np.zeros((len(coeff_temp), self.number_of_channels), dtype=np.int32)
 
-        self.buffer_coeffs = [None]*self.cells_in_buffer
-        for i in range(self.cells_in_buffer):
-            self.buffer_coeffs[i] = np.zeros((self.frames_per_chunk, 2), dtype=np.int32)
+        self.overlap = 0
+        if args.overlap:
+            #The chunks are transformed with the overlap samples of the adjacent chunks at both sides
+            if self.transform == "pywt":
+                filter_length = pywt.Wavelet(wavelet).dec_len
+            else:
+                filter_length = Lifting_DWT.FILTER_LENGTH[self.transform]
+            self.overlap = Overlapped_DWT.get_overlap(filter_length, level)
+        frames = self.frames_per_chunk + 2*self.overlap
 
-    def receive_and_buffer(self):
-        message, source_address = self.receiving_sock.recvfrom(Intercom.MAX_MESSAGE_SIZE)
-        received_chunk_number, received_bitplane_number, self.NORB, *bitplane = struct.unpack(self.packet_format, message)
-        bitplane = np.asarray(bitplane, dtype=np.uint8)
-        bitplane = np.unpackbits(bitplane)
-        #We change the format to int32
-        bitplane = bitplane.astype(np.int32)
-        #We store the coefficients received in the buffer created to store them
-        self.buffer_coeffs[received_chunk_number % self.cells_in_buffer][:, received_bitplane_number%self.number_of_channels] |= (bitplane << received_bitplane_number//self.number_of_channels)
-        self.received_bitplanes_per_chunk[received_chunk_number % self.cells_in_buffer] += 1
-        return received_chunk_number
+        if self.transform == "pywt":
+            zeros = np.zeros(frames)
+            coeff_slices = pywt.coeffs_to_array(pywt.wavedec(zeros, wavelet=wavelet, mode=padding, level=level))[1]
+            self.dwt = Wavelet_plan(wavelet, padding, level, coeff_slices, frames, self.number_of_channels)
+            self.received_coeffs = np.zeros((frames, self.number_of_channels), dtype=np.float64)
+            dtype = np.float64
+            #The coefficients are sent in two's complement
+            self.sign_bit = None
+            self.sign_bit_position = 31
+        else:
+            #The integer transform is computed without floats and its coefficients require less bitplanes
+            self.dwt = Lifting_DWT(self.transform, frames, self.number_of_channels, level)
+            dtype = np.int32
+            self.max_NOBPTS = Lifting_DWT.BITS_PER_COEFFICIENT*self.number_of_channels
+            self.sign_bit = np.uint32(1 << (Lifting_DWT.BITS_PER_COEFFICIENT - 1))
+            self.sign_bit_position = Lifting_DWT.BITS_PER_COEFFICIENT - 1
+            self.samples = np.zeros((self.frames_per_chunk, self.number_of_channels), dtype=np.int32)
 
+        if self.overlap:
+            self.dwt = Overlapped_DWT(self.dwt, self.overlap, level, self.frames_per_chunk, self.number_of_channels, dtype)
+
+        if __debug__:
+            print(f"transform={self.transform}")
+            print(f"overlap={self.overlap}")
+            #The sender waits for the next chunk and the receiver for its coefficients
+            print(f"lookahead_latency={2*self.chunk_period*1000 if self.overlap else 0:.1f} ms")
+
+        self.buffer_coeffs = np.zeros((self.cells_in_buffer, self.frames_per_chunk, self.number_of_channels), dtype=np.int32)
+
+        #The received bitplanes are stored in the buffer of coefficients
+        self.set_bitplane_cells(self.buffer_coeffs)
+
+    #Resets a cell that is not going to be played (see adapt_playout
+    #and drop_chunk). With overlap, the coefficients of its chunk are
+    #still needed to compute the next chunk, so, as when the cell is
+    #played (see inverse_transform_and_clear), the coefficients that
+    #are cleared are the ones of two cells before.
+    def clear_cell(self, cell):
+        Intercom_empty.clear_cell(self, cell)
+        if self.overlap:
+            self.buffer_coeffs[(cell - 2) % self.cells_in_buffer].fill(0)
+        else:
+            self.buffer_coeffs[cell].fill(0)
+
+    #Computes the coefficients (in sign-magnitude) of the indata, into buffer_send
+    def forward_transform(self, indata):
+        if self.transform == "pywt":
+            signs = indata & 0x8000
+            magnitudes = abs(indata)
+            indata = signs | magnitudes
+
+            #We make the discrete wavelet transform of the indata
+            coeffs = self.dwt.forward(indata)
+            #We multiply the data by a specifiied factor and store the coefficients into the buffer
+            np.multiply(coeffs, factor, out=self.buffer_send, casting="unsafe")
+        else:
+            self.dwt.forward(indata, self.buffer_send)
+        if self.sign_bit:
+            #The sign of the coefficients is placed in their most significant bitplane
+            negatives = self.buffer_send < 0
+            np.abs(self.buffer_send, out=self.buffer_send)
+            np.bitwise_or(self.buffer_send.view(np.uint32), self.sign_bit, out=self.buffer_send.view(np.uint32), where=negatives)
+
+    #Computes the samples of the received coefficients of a cell, into chunk
+    def inverse_transform(self, cell, chunk):
+        if self.overlap:
+            coeffs = self.dwt.window(self.buffer_coeffs, cell)
+        else:
+            coeffs = self.buffer_coeffs[cell]
+        if self.sign_bit:
+            magnitudes = coeffs.view(np.uint32)
+            negatives = (magnitudes & self.sign_bit) != 0
+            magnitudes &= ~self.sign_bit
+            np.negative(coeffs, out=coeffs, where=negatives)
+        if self.transform == "pywt":
+            #We divide the data by the factor to restore it
+            np.divide(coeffs, factor, out=self.received_coeffs)
+
+            #We make the inverse discrete wavelet transform and parse the chunk to int16 to play the data
+            samples = self.dwt.inverse(self.received_coeffs).astype(np.int16)
+
+            signs = samples >> 15
+            magnitudes = samples & 0x7FFF
+            #chunk = ((~signs & magnitudes) | ((-magnitudes) & signs))
+            chunk[:] = magnitudes + magnitudes*signs*2
+        else:
+            self.dwt.inverse(coeffs, self.samples)
+            #Partially received chunks can be out of range
+            np.clip(self.samples, -32768, 32767, out=self.samples)
+            chunk[:] = self.samples
+
+    #Computes the chunk to play from the coefficients buffer, and then
+    #resets the cell of the coefficients that will not be used
+    #again. With overlap, the played chunk is the previous one, because
+    #the coefficients of the next one are also needed.
+    def inverse_transform_and_clear(self):
+        cell = self.played_chunk_number % self.cells_in_buffer
+        if self.overlap:
+            self.inverse_transform((cell - 1) % self.cells_in_buffer, self._buffer[cell])
+            self.buffer_coeffs[(cell - 2) % self.cells_in_buffer].fill(0)
+        else:
+            self.inverse_transform(cell, self._buffer[cell])
+            self.buffer_coeffs[cell].fill(0)
+
+    #Extracts the bitplanes of the coefficients. In two's complement
+    #the negative coefficients make all the upper bitplanes
+    #significant, so all of them are extracted.
+    def extract_coefficient_bitplanes(self):
+        if self.sign_bit:
+            self.number_of_significant_bitplanes = self.extract_significant_bitplanes(self.buffer_send)
+        else:
+            self.extract_bitplanes(self.buffer_send)
+            self.significant = np.ones(32*self.number_of_channels, dtype=bool)
+            self.number_of_significant_bitplanes = len(self.significant)
 
     def send(self, indata):
-        signs = indata & 0x8000
-        magnitudes = abs(indata)
-        indata = signs | magnitudes
-
-        #For each channel, we make the discrete wavelet transform of the indata
-        for i in range(self.number_of_channels):
-            coeffs = pywt.wavedec(indata[:,i], wavelet=wavelet, mode=padding, level=level)
-            coeffs_, slices = pywt.coeffs_to_array(coeffs)
-            #We multiply the data by a specifiied factor
-            coeffs_ = np.multiply(coeffs_, factor)
-            #We store the coefficient array into the buffer
-            self.buffer_send[:,i] = coeffs_.astype(np.int32)
-
-        self.NOBPTS = int(0.75*self.NOBPTS + 0.25*self.NORB)
-        self.NOBPTS += self.skipped_bitplanes[(self.played_chunk_number+1) % self.cells_in_buffer]
+        self.forward_transform(indata)
+        self.extract_coefficient_bitplanes()
+
+        self.update_NOBPTS(self.skipped_bitplanes[(self.played_chunk_number+1) % self.cells_in_buffer])
         self.skipped_bitplanes[(self.played_chunk_number+1) % self.cells_in_buffer] = 0
-        self.NOBPTS += 1
-        if self.NOBPTS > self.max_NOBPTS:
-            self.NOBPTS = self.max_NOBPTS
         last_BPTS = - 1
+        if self.coder:
+            self.encode_bitplanes(self.buffer_send, np.flatnonzero(self.significant).tolist())
 
         for bitplane_number in range(self.max_NOBPTS-1, last_BPTS, -1):
-            #We send the buffer with the coefficients instead of the indata
-            self.send_bitplane(self.buffer_send, bitplane_number)
+            #We send the bitplanes of the coefficients instead of the ones of the indata
+            self.send_bitplane(bitplane_number)
+        self.send_packet()
         self.recorded_chunk_number = (self.recorded_chunk_number + 1) % self.MAX_CHUNK_NUMBER
 
     def record_send_and_play_stereo(self, indata, outdata, frames, time, status):
         indata[:,0] -= indata[:,1]
         self.send(indata)
 
-        #We get the chunk from the coefficients buffer
-        chunk = self.buffer_coeffs[self.played_chunk_number % self.cells_in_buffer]
-        #Once we get the chunk, we reset the buffer
-        self.buffer_coeffs[self.played_chunk_number % self.cells_in_buffer] = np.zeros((self.frames_per_chunk, 2), dtype=np.int32)
-        #We divide the data by the factor to restore it
-        chunk = np.divide(chunk, factor)
-
-        #For each channel, we make the inverse discrete wavelet transform of the indata
-        for i in range(self.number_of_channels):
-            coeffs_from_arr = pywt.array_to_coeffs(chunk[:,i], self.coeff_slices, output_format="wavedec")
-            sample = pywt.waverec(coeffs_from_arr, wavelet=wavelet, mode=padding)
-            chunk[:,i] = sample
-
-        #We parse the chunk to int16 to play the data
-        chunk = chunk.astype(np.int16)
-
-        signs = chunk >> 15
-        magnitudes = chunk & 0x7FFF
-        #chunk = ((~signs & magnitudes) | ((-magnitudes) & signs))
-        chunk = magnitudes + magnitudes*signs*2
-        self._buffer[self.played_chunk_number % self.cells_in_buffer]  = chunk
+        self.inverse_transform_and_clear()
 
         self._buffer[self.played_chunk_number % self.cells_in_buffer][:,0] += self._buffer[self.played_chunk_number % self.cells_in_buffer][:,1]
         self.play(outdata)
@@ -180,6 +449,18 @@ class Intercom_DWT(Intercom_empty):
         self.received_bitplanes_per_chunk [self.played_chunk_number % self.cells_in_buffer] = 0
         #print(*self.received_bitplanes_per_chunk)
 
+    def record_send_and_play(self, indata, outdata, frames, time, status):
+        self.send(indata)
+        self.inverse_transform_and_clear()
+        self.play(outdata)
+        self.received_bitplanes_per_chunk [self.played_chunk_number % self.cells_in_buffer] = 0
+
+    def add_args(self):
+        parser = Intercom_empty.add_args(self)
+        parser.add_argument("-tr", "--transform", help="DWT: floating-point (pywt) or integer lifting (haar or legall53).", choices=["pywt", "haar", "legall53"], default="pywt")
+        parser.add_argument("-ov", "--overlap", action="store_true", help="Transform the chunks with the adjacent samples (adds 2 chunks of latency).")
+        return parser
+
 if __name__ == "__main__":
     intercom = Intercom_DWT()
     parser = intercom.add_args()
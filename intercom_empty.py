@@ -5,8 +5,15 @@
 # sent. It is also considered that the signs bitplane cound be all
 # positives, something that could happen when we send a mono signal
 # using two channels or the number of samples/chunk is very small.
+#
+# The empty bitplanes are found once per chunk: the OR of all the
+# samples of a channel has a 1 in the bits whose bitplane is not
+# empty (so, its bit length is the one of the largest magnitude, and
+# the sign bit is set if some sample is negative). The rest of
+# bitplanes are neither extracted nor tested. The number of
+# significant bitplanes of the chunk is sent in the header, and the
+# receiver shows it as the volume of the played chunk.
 
-import struct
 import numpy as np
 from intercom import Intercom
 from intercom_dfc import Intercom_DFC
@@ -18,38 +25,71 @@ class Intercom_empty(Intercom_DFC):
 
     def init(self, args):
         Intercom_DFC.init(self, args)
+        self.set_bitplanes_packet_format([("chunk_number", ">u2"), ("bitmap", ">u8"), ("NORB", "u1"), ("significant_bitplanes", "u1")] + self.rate_controller.HEADER_FIELDS)
         self.skipped_bitplanes = [0]*self.cells_in_buffer
+        self.significant_bitplanes_per_chunk = [0]*self.cells_in_buffer
+        self.number_of_significant_bitplanes = 0
+
+    # Finds the significant (not empty) bitplanes of a chunk and
+    # extracts only them. After that, self.significant[n] indicates if
+    # the bitplane n is significant. Returns the number of significant
+    # bitplanes.
+    def extract_significant_bitplanes(self, samples):
+        bits_per_sample = samples.dtype.itemsize*8
+        ORs = np.bitwise_or.reduce(np.ascontiguousarray(samples.T).view(f"u{samples.dtype.itemsize}"), axis=1)
+        masks = np.left_shift(1, np.arange(bits_per_sample, dtype=ORs.dtype), dtype=ORs.dtype)
+        self.significant = ((ORs & masks[:, None]) != 0).reshape(-1)
+        self.extract_bitplanes(samples, np.flatnonzero(np.bitwise_or.reduce(ORs) & masks))
+        return int(np.count_nonzero(self.significant))
 
-    def send_bitplane(self, indata, bitplane_number):
-        bitplane = (indata[:, bitplane_number%self.number_of_channels] >> bitplane_number//self.number_of_channels) & 1
-        if np.any(bitplane): 
-            bitplane = bitplane.astype(np.uint8)
-            bitplane = np.packbits(bitplane)
-            message = struct.pack(self.packet_format, self.recorded_chunk_number, bitplane_number, self.received_bitplanes_per_chunk[(self.played_chunk_number+1) % self.cells_in_buffer]+1, *bitplane)
-            self.sending_sock.sendto(message, (self.destination_IP_addr, self.destination_port))
+    def send_bitplane(self, bitplane_number):
+        if self.significant[bitplane_number]:
+            Intercom_DFC.send_bitplane(self, bitplane_number)
         else:
             self.skipped_bitplanes[self.recorded_chunk_number % self.cells_in_buffer] += 1
 
+    def send_packet(self):
+        self.packet_header["significant_bitplanes"] = self.number_of_significant_bitplanes
+        Intercom_DFC.send_packet(self)
+
+    def buffer_message(self, message):
+        header, payload = self.unpack(message)
+        if header["bitmap"] == 0:
+            return self.receive_report(header, payload)
+        received_chunk_number = int(header["chunk_number"])
+        self.NORB = int(header["NORB"])
+        self.significant_bitplanes_per_chunk[received_chunk_number % self.cells_in_buffer] = int(header["significant_bitplanes"])
+        self.received_bitplanes_per_chunk[received_chunk_number % self.cells_in_buffer] += self.buffer_bitplanes(received_chunk_number, int(header["bitmap"]), payload, self.get_coded_bitmap(header))
+        return received_chunk_number
+
     def send(self, indata):
         signs = indata & 0x8000
         magnitudes = abs(indata)
         indata = signs | magnitudes
-        self.NOBPTS = int(0.75*self.NOBPTS + 0.25*self.NORB)
-        self.NOBPTS += self.skipped_bitplanes[(self.played_chunk_number+1) % self.cells_in_buffer]
+        self.number_of_significant_bitplanes = self.extract_significant_bitplanes(indata)
+        self.update_NOBPTS(self.skipped_bitplanes[(self.played_chunk_number+1) % self.cells_in_buffer])
         self.skipped_bitplanes[(self.played_chunk_number+1) % self.cells_in_buffer] = 0
-        self.NOBPTS += 1
-        if self.NOBPTS > self.max_NOBPTS:
-            self.NOBPTS = self.max_NOBPTS
         last_BPTS = self.max_NOBPTS - self.NOBPTS - 1
+        if self.coder:
+            self.encode_bitplanes(indata, [n for n in range(self.max_NOBPTS-1, last_BPTS, -1) if self.significant[n]])
         #self.send_bitplane(indata, self.max_NOBPTS-1)
         #self.send_bitplane(indata, self.max_NOBPTS-2)
         #for bitplane_number in range(self.max_NOBPTS-3, last_BPTS, -1):
         for bitplane_number in range(self.max_NOBPTS-1, last_BPTS, -1):
-            self.send_bitplane(indata, bitplane_number)
+            self.send_bitplane(bitplane_number)
+        self.send_packet()
         self.recorded_chunk_number = (self.recorded_chunk_number + 1) % self.MAX_CHUNK_NUMBER
 
+    def clear_cell(self, cell):
+        Intercom_DFC.clear_cell(self, cell)
+        self.significant_bitplanes_per_chunk[cell] = 0
+
+    # Shows the number of significant bitplanes of the chunk just
+    # played, which is reset because the cell will be reused.
     def feedback(self):
-        volume = "*"*(30-self.skipped_bitplanes[(self.played_chunk_number+1) % self.cells_in_buffer])
+        played_cell = (self.played_chunk_number - 1) % self.cells_in_buffer
+        volume = "*"*self.significant_bitplanes_per_chunk[played_cell]
+        self.significant_bitplanes_per_chunk[played_cell] = 0
         sys.stderr.write(volume + '\n'); sys.stderr.flush()
 
 if __name__ == "__main__":
@@ -0,0 +1,223 @@
+# Sending the DWT coefficients by subbands, in rate-distortion order.
+#
+# Intercom_DWT sends complete bitplanes of the coefficients of each
+# channel, although most of the energy is in the low-frequency
+# subbands and most of the bits of the high-frequency subbands are
+# 0. Here, the bitplanes are split into their subbands, and the
+# transmission unit is the (channel, subband, bitplane) triplet:
+#
+# Bitplane
+#    31 |ooooo|ooooo|oooooooooo|oooooooooooooooooooo|
+#    30 |ooooo|ooooo|oooooooooo|oooooooooooooooooooo|
+#    ...
+#     0 |ooooo|ooooo|oooooooooo|oooooooooooooooooooo|
+#       +-----+-----+----------+--------------------+
+#          L4    H4      H3             ...
+#
+# The units are sent sorted by the reduction of the distortion that
+# they produce at the receiver, which is proportional to 4**bitplane
+# (the squared weight of the bit) and to the energy of the basis
+# functions of the subband (see test/pywavelets/subband_gains.py). So,
+# for example, a bitplane of the L4 subband is sent before the same
+# bitplane of the H1 subband when the filters are not orthonormal. The
+# order is the same for all the chunks, and the packets indicate the
+# units that they carry with the number of the first one and a
+# bitmap of the following 64 units. Empty units are not sent.
+#
+# The Data-Flow Control works with units instead of bitplanes: NORB
+# is the number of received units, and the sender truncates the
+# sequence of units at NOBPTS.
+#
+# The sign of the coefficients is sent in the most significant
+# bitplane, also when pywt is used, in order to be able to truncate
+# the coefficients.
+#
+# With --coder, each unit is coded as a region of its bitplane (with
+# --coder rice, the coded units are indicated by another bitmap, as
+# the units).
+
+import numpy as np
+from intercom import Intercom
+from intercom_buffer import Intercom_buffer
+from intercom_dwt import Intercom_DWT, Lifting_DWT, Wavelet_plan
+import intercom_dwt
+
+if __debug__:
+    import sys
+
+class Intercom_subbands(Intercom_DWT):
+
+    def init(self, args):
+        Intercom_DWT.init(self, args)
+        if self.transform == "pywt":
+            bits_per_coefficient = 32
+            self.sign_bit = np.uint32(1 << 31)
+        else:
+            bits_per_coefficient = Lifting_DWT.BITS_PER_COEFFICIENT
+
+        #Subbands, as [start, stop) of the coefficients, from L_levels to H_1
+        self.subbands = [(s[0].start or 0, s[0].stop) for s in [self.coeff_slices[0]] + [slices["d"] for slices in self.coeff_slices[1:]]]
+        assert all(start % 8 == 0 and stop % 8 == 0 for start, stop in self.subbands)
+
+        #The units, sorted by their gains
+        gains = self.get_subband_gains()
+        channel_gains = self.get_channel_gains()
+        units = [(c, s, b) for c in range(self.number_of_channels) for s in range(len(self.subbands)) for b in range(bits_per_coefficient)]
+        units.sort(key=lambda unit: channel_gains[unit[0]]*gains[unit[1]]*4.0**unit[2], reverse=True)
+        self.units = [(c, *self.subbands[s], b) for c, s, b in units]
+
+        #The subbands are contiguous, so the coefficients of each one
+        #are ORed with a single reduceat (see find_empty_units)
+        assert self.subbands[0][0] == 0 and all(stop == start for (_, stop), (start, _) in zip(self.subbands, self.subbands[1:]))
+        self.subband_starts = [start for start, stop in self.subbands]
+        self.unit_channels = np.array([c for c, s, b in units], dtype=np.intp)
+        self.unit_subbands = np.array([s for c, s, b in units], dtype=np.intp)
+        self.unit_bitplanes = np.array([b for c, s, b in units], dtype=np.uint32)
+
+        self.max_NOBPTS = len(self.units)
+        self.NOBPTS = self.max_NOBPTS
+        self.NORB = self.max_NOBPTS
+        self.set_units_packet_format([("chunk_number", ">u2"), ("first_unit", ">u2"), ("bitmap", ">u8"), ("NORB", ">u2"), ("significant_bitplanes", "u1")] + self.rate_controller.HEADER_FIELDS)
+
+        if __debug__:
+            print(f"subband_gains={' '.join(f'{gain:.2f}' for gain in gains)}")
+            print(f"units={len(self.units)}")
+
+    # Energy of the basis functions of each subband (the energy of
+    # the inverse transform of a coefficient), relative to the energy
+    # of the coefficient.
+    def get_subband_gains(self):
+        if self.transform == "pywt":
+            dwt = Wavelet_plan(intercom_dwt.wavelet, intercom_dwt.padding, intercom_dwt.level, self.coeff_slices, self.frames_per_chunk, 1)
+            coeffs = np.zeros((self.frames_per_chunk, 1), dtype=np.float64)
+            samples = np.zeros((self.frames_per_chunk, 1), dtype=np.float64)
+        else:
+            dwt = Lifting_DWT(self.transform, self.frames_per_chunk, 1, intercom_dwt.level)
+            coeffs = np.zeros((self.frames_per_chunk, 1), dtype=np.int32)
+            samples = np.zeros((self.frames_per_chunk, 1), dtype=np.int32)
+        #Large enough to make negligible the rounding of the integer transforms
+        amplitude = 1 << 12
+        gains = []
+        for start, stop in self.subbands:
+            coeffs.fill(0)
+            coeffs[(start + stop)//2] = amplitude
+            dwt.inverse(coeffs, samples)
+            gains.append(np.sum(samples.astype(np.float64)**2)/amplitude**2)
+        return gains
+
+    # In stereo, the channel 0 is L-R and the channel 1 is R, so the
+    # errors in the channel 1 appear in both L and R.
+    def get_channel_gains(self):
+        if self.number_of_channels == 2:
+            return [1, 2]
+        return [1]*self.number_of_channels
+
+    # The units have different sizes, so the payload can hold as many
+    # bytes as fit in the MTU (at least the largest unit).
+    def set_units_packet_format(self, header_dtype):
+        largest_unit = max(stop - start for start, stop in self.subbands)//8
+        if self.coder:
+            largest_unit += 2 + self.coder.HEADER_SIZE
+            if self.coder.INDEPENDENT_REGIONS:
+                header_dtype = header_dtype + [("coded_bitmap", ">u8")]
+        payload_size = max(largest_unit, self.mtu - Intercom_buffer.IP_UDP_HEADERS_SIZE - np.dtype(header_dtype).itemsize)
+        self.set_packet_format(header_dtype, np.uint8, payload_size)
+        self.packed_bytes = 0
+        self.packed_bitmap = 0
+        self.packed_coded_bitmap = 0
+        self.first_packed_unit = 0
+
+    def get_region(self, unit_number):
+        return self.units[unit_number]
+
+    # Finds, at once, the empty units of the chunk: the OR of the
+    # coefficients of each subband and channel has the bits of its
+    # units that are not empty.
+    def find_empty_units(self):
+        ORs = np.bitwise_or.reduceat(self.buffer_send.view(np.uint32), self.subband_starts, axis=0)
+        self.empty_units = ((ORs[self.unit_subbands, self.unit_channels] >> self.unit_bitplanes) & 1) == 0
+
+    # Empty units (and the ones of non-significant bitplanes) are not
+    # sent.
+    def is_empty_unit(self, unit_number):
+        return self.empty_units[unit_number]
+
+    def get_unit(self, unit_number):
+        if self.is_coded(unit_number):
+            return self.records[unit_number]
+        channel, start, stop, bitplane = self.units[unit_number]
+        return self.bitplanes[bitplane, channel, start//8:stop//8]
+
+    # Adds a unit to the packet in construction, sending it before if
+    # the unit does not fit or is too far from the first unit of the
+    # packet. Empty units are skipped.
+    def send_unit(self, unit_number):
+        if self.is_empty_unit(unit_number):
+            self.skipped_bitplanes[self.recorded_chunk_number % self.cells_in_buffer] += 1
+            return
+        unit = self.get_unit(unit_number)
+        if self.packed_bitmap and (self.packed_bytes + len(unit) > len(self.packet_payload) or unit_number - self.first_packed_unit > 63):
+            self.send_packet()
+        if not self.packed_bitmap:
+            self.first_packed_unit = unit_number
+        self.packet_payload[self.packed_bytes:self.packed_bytes + len(unit)] = unit
+        self.packed_bytes += len(unit)
+        self.packed_bitmap |= 1 << (63 - (unit_number - self.first_packed_unit))
+        if self.is_coded(unit_number):
+            self.packed_coded_bitmap |= 1 << (63 - (unit_number - self.first_packed_unit))
+
+    def send_packet(self):
+        self.packet_header["first_unit"] = self.first_packed_unit
+        Intercom_DWT.send_packet(self)
+
+    def send(self, indata):
+        self.forward_transform(indata)
+        self.extract_coefficient_bitplanes()
+
+        self.update_NOBPTS(self.skipped_bitplanes[(self.played_chunk_number+1) % self.cells_in_buffer])
+        self.skipped_bitplanes[(self.played_chunk_number+1) % self.cells_in_buffer] = 0
+        self.find_empty_units()
+        if self.coder:
+            self.encode_bitplanes(self.buffer_send, np.flatnonzero(~self.empty_units[:self.NOBPTS]).tolist())
+
+        for unit_number in range(self.NOBPTS):
+            self.send_unit(unit_number)
+        self.send_packet()
+        self.recorded_chunk_number = (self.recorded_chunk_number + 1) % self.MAX_CHUNK_NUMBER
+
+    # Buffers the units of a packet, indicated by the first unit and
+    # the bitmap (from its most significant bit). Returns the number
+    # of units.
+    def buffer_units(self, chunk_number, first_unit, bitmap, payload, coded_bitmap=0):
+        cell = self.bitplane_cells[chunk_number % self.cells_in_buffer]
+        number_of_units = 0
+        offset = 0
+        while bitmap:
+            bit = bitmap.bit_length() - 1
+            bitmap ^= 1 << bit
+            if (coded_bitmap >> bit) & 1:
+                offset = self.buffer_record(chunk_number, first_unit + 63 - bit, payload, offset)
+            else:
+                channel, start, stop, bitplane = self.units[first_unit + 63 - bit]
+                length = (stop - start)//8
+                cell[start:stop, channel] |= self.bitplane_table[bitplane].take(payload[offset:offset + length], axis=0).reshape(-1)
+                offset += length
+            number_of_units += 1
+        return number_of_units
+
+    def buffer_message(self, message):
+        header, payload = self.unpack(message)
+        if header["bitmap"] == 0:
+            return self.receive_report(header, payload)
+        received_chunk_number = int(header["chunk_number"])
+        self.NORB = int(header["NORB"])
+        self.significant_bitplanes_per_chunk[received_chunk_number % self.cells_in_buffer] = int(header["significant_bitplanes"])
+        self.received_bitplanes_per_chunk[received_chunk_number % self.cells_in_buffer] += self.buffer_units(received_chunk_number, int(header["first_unit"]), int(header["bitmap"]), payload, self.get_coded_bitmap(header))
+        return received_chunk_number
+
+if __name__ == "__main__":
+    intercom = Intercom_subbands()
+    parser = intercom.add_args()
+    args = parser.parse_args()
+    intercom.init(args)
+    intercom.run()
@@ -0,0 +1,115 @@
+# Latency histograms of the stages of an intercom.
+#
+# The times (in nanoseconds) are counted in HDR-style (High Dynamic
+# Range) histograms: the buckets are linear up to 2**SUB_BUCKET_BITS
+# ns, and then each power of 2 is split into 2**(SUB_BUCKET_BITS-1)
+# buckets, so any time up to 2**MAX_BITS ns is counted with a
+# relative error below 1/2**(SUB_BUCKET_BITS-1) in a fixed number of
+# buckets. The counters of each stage are preallocated in an
+# array.array (which numpy reads without copying), so recording a
+# time only computes the index of its bucket and increments it.
+#
+# The stages (see STAGES) are timed by replacing the methods that
+# compute them with timed versions (see timed), and the audio
+# callback (see timed_callback), which also records the latencies of
+# the audio device: capture (from the ADC to the callback) and
+# playout (from the callback to the DAC).
+
+import array
+import numpy as np
+from time import perf_counter_ns
+
+class Latency_histograms:
+
+    SUB_BUCKET_BITS = 5                                                         # 16 buckets per power of 2 (error < 6.25%)
+    MAX_BITS = 40                                                               # Up to 2**40 ns (around 18 minutes)
+    STAGES = ["capture", "transform", "extraction", "send", "receive", "reassembly", "inverse_transform", "playout", "callback"]
+
+    def __init__(self):
+        half = 1 << (self.SUB_BUCKET_BITS - 1)
+        self.number_of_buckets = (self.MAX_BITS - self.SUB_BUCKET_BITS + 2)*half
+        self.counts = [array.array("q", bytes(8*self.number_of_buckets)) for stage in self.STAGES]
+        self.maxima = [0]*len(self.STAGES)
+        #The counts at the last report, to report the differences
+        self.reported_counts = np.zeros((len(self.STAGES), self.number_of_buckets), np.int64)
+        self.lower_bounds = np.array([self.get_lower_bound(index) for index in range(self.number_of_buckets + 1)], np.int64)
+
+    def get_lower_bound(self, index):
+        half = 1 << (self.SUB_BUCKET_BITS - 1)
+        if index < 2*half:
+            return index
+        exponent = index//half - 1
+        return (index - exponent*half) << exponent
+
+    # The bucket of a time of 2**SUB_BUCKET_BITS ns or more is given
+    # by its exponent (bit length) and its SUB_BUCKET_BITS most
+    # significant bits. The negative and too large times are counted
+    # in the first and last buckets.
+    def record(self, stage, nanoseconds):
+        exponent = nanoseconds.bit_length() - self.SUB_BUCKET_BITS
+        if exponent <= 0:
+            self.counts[stage][max(nanoseconds, 0)] += 1
+        elif exponent <= self.MAX_BITS - self.SUB_BUCKET_BITS:
+            self.counts[stage][(exponent << (self.SUB_BUCKET_BITS - 1)) + (nanoseconds >> exponent)] += 1
+        else:
+            self.counts[stage][-1] += 1
+        if nanoseconds > self.maxima[stage]:
+            self.maxima[stage] = nanoseconds
+
+    # Returns a function that calls the method and records its time
+    # in the stage.
+    def timed(self, stage_name, method):
+        stage = self.STAGES.index(stage_name)
+        record = self.record
+        def timed_method(*args):
+            start = perf_counter_ns()
+            result = method(*args)
+            record(stage, perf_counter_ns() - start)
+            return result
+        return timed_method
+
+    # Returns an audio callback (see sounddevice.Stream) that calls
+    # the callback and records its time and the latencies of the
+    # audio device (if it provides the time information).
+    def timed_callback(self, callback):
+        capture, playout, duration = (self.STAGES.index(stage_name) for stage_name in ("capture", "playout", "callback"))
+        record = self.record
+        def timed_callback(indata, outdata, frames, time, status):
+            start = perf_counter_ns()
+            callback(indata, outdata, frames, time, status)
+            record(duration, perf_counter_ns() - start)
+            if time:
+                record(capture, int((time.currentTime - time.inputBufferAdcTime)*1e9))
+                record(playout, int((time.outputBufferDacTime - time.currentTime)*1e9))
+        return timed_callback
+
+    # Returns a text with the number of times, the 50th and 99th
+    # percentiles and the maximum (in microseconds) of each stage
+    # recorded since the last report (or None if nothing has been
+    # recorded). The percentiles are the upper bounds of their
+    # buckets.
+    def report(self):
+        lines = [f"{'latency (us)':>17} {'count':>8} {'p50':>10} {'p99':>10} {'max':>10}"]
+        for stage, stage_name in enumerate(self.STAGES):
+            counts = np.frombuffer(self.counts[stage], np.int64).copy()
+            interval_counts = counts - self.reported_counts[stage]
+            self.reported_counts[stage] = counts
+            maximum, self.maxima[stage] = self.maxima[stage], 0
+            number_of_times = int(np.sum(interval_counts))
+            if number_of_times == 0:
+                continue
+            cumulative_counts = np.cumsum(interval_counts)
+            p50, p99 = (min(self.lower_bounds[np.searchsorted(cumulative_counts, percentile*number_of_times) + 1] - 1, maximum) for percentile in (0.5, 0.99))
+            lines.append(f"{stage_name:>17} {number_of_times:8d} {p50/1000:10.1f} {p99/1000:10.1f} {maximum/1000:10.1f}")
+        if len(lines) > 1:
+            return "\n".join(lines)
+
+if __name__ == "__main__":
+    #Compares the percentiles of the histograms with the exact ones
+    rng = np.random.default_rng(0)
+    times = rng.lognormal(np.log(20000), 1.0, 100000).astype(np.int64)
+    histograms = Latency_histograms()
+    for nanoseconds in times.tolist():
+        histograms.record(0, nanoseconds)
+    print(histograms.report())
+    print(f"{'exact':>17} {len(times):8d} {np.percentile(times, 50)/1000:10.1f} {np.percentile(times, 99)/1000:10.1f} {np.max(times)/1000:10.1f}")
@@ -0,0 +1,115 @@
+# Metrics of an intercom session, exported in the text format of
+# Prometheus (https://prometheus.io/docs/instrumenting/exposition_formats/).
+#
+# The counters and gauges are plain attributes of a Metrics object
+# (see COUNTERS and GAUGES), updated without locks: each one is
+# written by only one thread (the audio callback, the sender stage of
+# --pipeline or the receiver), and the endpoint only reads them, so
+# an update is a single store of an int that is never seen halfway.
+# The flags of the status argument of the audio callback (the xruns)
+# are counted by wrapping the callback (see counted_callback).
+#
+# The endpoint is an HTTP server, in its own thread, at a TCP port
+# ("port" or "address:port", only local by default) or at a UNIX
+# socket (a path), for example:
+#
+#   curl http://localhost:9100/metrics
+#   curl --unix-socket /tmp/intercom.sock http://localhost/metrics
+
+import http.server
+import os
+import socketserver
+import threading
+
+class Metrics:
+
+    PREFIX = "intercom_"
+    COUNTERS = [
+        ("packets_sent", "Packets sent."),
+        ("bytes_sent", "Bytes sent (UDP payloads)."),
+        ("packets_received", "Packets received."),
+        ("bytes_received", "Bytes received (UDP payloads)."),
+        ("chunks_played", "Chunks played."),
+        ("empty_chunks_played", "Chunks played from a cell where no packet was received."),
+        ("late_packets", "Packets of chunks older than the window of the buffer (already played)."),
+        ("duplicate_packets", "Packets received more than once."),
+        ("nobpts_updates", "Updates of NOBPTS (one per sent chunk)."),
+        ("nobpts_sum", "Sum of the NOBPTS of the sent chunks (its rate divided by the one of the updates is the average)."),
+        ("norb_sum", "Sum of the NORB fed back to each update of NOBPTS."),
+        ("pipeline_late_chunks", "Audio callbacks (with --pipeline) that played silence because the sender stage had not prepared their chunk."),
+        ("pipeline_dropped_chunks", "Recorded chunks dropped (not sent) by the sender stage (with --pipeline) because a newer one had been recorded.")]
+    GAUGES = [
+        ("nobpts", "Number Of BitPlanes To Send of the last chunk."),
+        ("norb", "Number Of Received BitPlanes fed back by the interlocutor to the last update of NOBPTS."),
+        ("buffer_depth", "Chunks in the buffer ahead of the played one (updated with --adaptive_buffering)."),
+        ("target_depth", "Target of the buffer depth (updated with --adaptive_buffering)."),
+        ("jitter_seconds", "Percentile (--jitter_percentile) of the variation of the transit time of the chunks (updated with --adaptive_buffering)."),
+        ("arrival_jitter_seconds", "Interarrival jitter (RFC 3550) of the chunks (updated with --report_interval).")]
+    XRUN_FLAGS = ["input_underflow", "input_overflow", "output_underflow", "output_overflow"]
+
+    def __init__(self):
+        for name, description in self.COUNTERS + self.GAUGES:
+            setattr(self, name, 0)
+        self.xruns = dict.fromkeys(self.XRUN_FLAGS, 0)
+
+    def record_NOBPTS(self, NOBPTS, NORB):
+        self.nobpts = NOBPTS
+        self.norb = NORB
+        self.nobpts_updates += 1
+        self.nobpts_sum += NOBPTS
+        self.norb_sum += NORB
+
+    # Returns an audio callback (see sounddevice.Stream) that counts
+    # the flags of the status and calls the callback.
+    def counted_callback(self, callback):
+        xruns = self.xruns
+        def counted_callback(indata, outdata, frames, time, status):
+            if status:
+                for flag in self.XRUN_FLAGS:
+                    if getattr(status, flag):
+                        xruns[flag] += 1
+            callback(indata, outdata, frames, time, status)
+        return counted_callback
+
+    def expose(self):
+        lines = []
+        for name, description in self.COUNTERS:
+            lines += [f"# HELP {self.PREFIX}{name}_total {description}", f"# TYPE {self.PREFIX}{name}_total counter", f"{self.PREFIX}{name}_total {getattr(self, name)}"]
+        for name, description in self.GAUGES:
+            lines += [f"# HELP {self.PREFIX}{name} {description}", f"# TYPE {self.PREFIX}{name} gauge", f"{self.PREFIX}{name} {getattr(self, name)}"]
+        lines += [f"# HELP {self.PREFIX}callback_xruns_total Audio callbacks with each flag of the status.", f"# TYPE {self.PREFIX}callback_xruns_total counter"]
+        lines += [f"{self.PREFIX}callback_xruns_total{{flag=\"{flag}\"}} {count}" for flag, count in self.xruns.items()]
+        return "\n".join(lines) + "\n"
+
+    # Starts the endpoint. Returns the server.
+    def serve(self, endpoint):
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.expose().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        if "/" in endpoint:
+            if os.path.exists(endpoint):
+                os.remove(endpoint)
+            server = Unix_HTTP_server(endpoint, Handler)
+        else:
+            address, _, port = endpoint.rpartition(":")
+            server = http.server.ThreadingHTTPServer((address or "127.0.0.1", int(port)), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+# HTTP at a UNIX socket. The clients have no address, so the (empty)
+# one of the socket is replaced for the handler.
+class Unix_HTTP_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def get_request(self):
+        request, client_address = socketserver.UnixStreamServer.get_request(self)
+        return request, ("local", 0)
@@ -0,0 +1,91 @@
+# Rate controllers of the Data-Flow Control (see the --rate_controller
+# option of Intercom_DFC).
+#
+# Before sending each chunk, the sender asks the controller the
+# number of bitplanes (or units, in Intercom_subbands) to send
+# (NOBPTS), from the feedback of the receiver about a previous chunk:
+#
+#   NORB:          the number of received bitplanes, plus one.
+#   skipped:       the bitplanes that were not sent because they were
+#                  empty.
+#   sent:          the NOBPTS used to send it.
+#   queuing_delay: the queuing delay (in seconds) of the packets of
+#                  the sender, measured by the receiver with
+#                  Queuing_delay_estimator (None, if not measured).
+#
+# A controller with FEEDBACK needs the queuing delay, so the packets
+# carry (in the HEADER_FIELDS) the time at which they are sent and the
+# queuing delay measured in the other direction.
+
+import collections
+
+class EWMA_controller:
+
+    FEEDBACK = False
+    HEADER_FIELDS = []
+
+    # The original algorithm: an exponentially weighted moving
+    # average of NORB, plus the skipped bitplanes, plus one (so that
+    # the rate increases while the bitplanes are received).
+    def get_NOBPTS(self, NOBPTS, max_NOBPTS, NORB, skipped, sent, queuing_delay):
+        NOBPTS = int(0.75*NOBPTS + 0.25*NORB) + skipped + 1
+        return min(NOBPTS, max_NOBPTS)
+
+# Delay_controller keeps the queuing delay near TARGET_DELAY, as
+# LEDBAT: the rate (in bitplanes per chunk) increases while the delay
+# is below the target (GAIN bitplanes per chunk with an empty queue)
+# and decreases, proportionally, when it is over it. So, it stops
+# growing before filling the queue of the bottleneck. When the
+# fraction of lost bitplanes is over LOSS_THRESHOLD, the rate is
+# decreased as in GCC: to the rate used, times (1 - loss/2).
+class Delay_controller:
+
+    FEEDBACK = True
+    HEADER_FIELDS = [("timestamp", ">u4"), ("queuing_delay", ">u2")]
+    TARGET_DELAY = 0.025                                                        # In seconds
+    GAIN = 1.0
+    LOSS_THRESHOLD = 0.1
+
+    def __init__(self):
+        self.rate = None
+
+    def get_NOBPTS(self, NOBPTS, max_NOBPTS, NORB, skipped, sent, queuing_delay):
+        if self.rate is None:
+            self.rate = float(NOBPTS)
+        loss = 1 - (NORB - 1 + skipped)/sent if sent else 0.0
+        if loss > self.LOSS_THRESHOLD:
+            self.rate = min(self.rate, sent)*(1 - loss/2)
+        elif queuing_delay is not None:
+            self.rate += self.GAIN*(self.TARGET_DELAY - queuing_delay)/self.TARGET_DELAY
+        self.rate = min(max(self.rate, 1.0), max_NOBPTS)
+        return int(self.rate)
+
+# Estimates the queuing delay of the received packets as LEDBAT: the
+# one-way delay (which includes the offset between the clocks of the
+# interlocutors) minus the base delay, the minimum one-way delay of
+# the last BASE_HISTORY intervals of BASE_INTERVAL seconds. The
+# current one-way delay is the minimum of the last CURRENT_FILTER
+# ones, to filter the jitter.
+class Queuing_delay_estimator:
+
+    BASE_HISTORY = 10
+    BASE_INTERVAL = 6.0                                                         # In seconds
+    CURRENT_FILTER = 4
+
+    def __init__(self):
+        self.base_delays = collections.deque([float("inf")], maxlen=self.BASE_HISTORY)
+        self.interval_start = None
+        self.current_delays = collections.deque(maxlen=self.CURRENT_FILTER)
+        self.queuing_delay = None
+
+    def update(self, one_way_delay, now):
+        if self.interval_start is None:
+            self.interval_start = now
+        if now - self.interval_start >= self.BASE_INTERVAL:
+            self.base_delays.append(float("inf"))
+            self.interval_start = now
+        if one_way_delay < self.base_delays[-1]:
+            self.base_delays[-1] = one_way_delay
+        self.current_delays.append(one_way_delay)
+        self.queuing_delay = min(self.current_delays) - min(self.base_delays)
+        return self.queuing_delay
@@ -0,0 +1,98 @@
+# Compares the coders of the bitplanes (see --coder): the bytes per
+# chunk of the payloads and the time spent coding and decoding them.
+# The arithmetic coder is not offered by --coder yet (it is too slow
+# for the chunk period), but it is compared here.
+#
+# The bitplanes are the significant ones of the chunks in
+# sign-magnitude (as Intercom_empty sends them) or of their LeGall 5/3
+# coefficients (as Intercom_DWT -tr legall53 does). The chunks are
+# read from a 16-bit WAV file or, by default, generated (a few
+# harmonics with a varying envelope plus noise).
+
+import argparse
+import sys
+import timeit
+import wave
+import numpy as np
+
+sys.path.insert(0, ".")
+from bitplane_coders import Arithmetic_coder, Rice_coder
+
+parser = argparse.ArgumentParser(description="Bitplane coders benchmark", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-s", "--frames_per_chunk", help="Frames per chunk.", type=int, default=1024)
+parser.add_argument("-c", "--number_of_channels", help="Number of channels (of the generated signal).", type=int, default=2)
+parser.add_argument("-n", "--number_of_chunks", help="Number of chunks.", type=int, default=20)
+parser.add_argument("-w", "--wav", help="16-bit WAV file with the signal.", type=str, default=None)
+parser.add_argument("-d", "--dwt", help="Code the coefficients of the LeGall 5/3 DWT instead of the samples.", action="store_true")
+args = parser.parse_args()
+
+if args.wav:
+    with wave.open(args.wav) as f:
+        assert f.getsampwidth() == 2
+        signal = np.frombuffer(f.readframes(args.frames_per_chunk*args.number_of_chunks), np.int16).reshape(-1, f.getnchannels())
+else:
+    rng = np.random.default_rng(0)
+    t = np.arange(args.frames_per_chunk*args.number_of_chunks)/44100
+    envelope = 0.5 + 0.5*np.sin(2*np.pi*3*t)**2
+    tones = sum(np.sin(2*np.pi*220*h*t)/h for h in range(1, 6))
+    signal = (4000*envelope*tones)[:, None] + rng.normal(0, 50, (len(t), args.number_of_channels))
+    signal = signal.astype(np.int16)
+number_of_channels = signal.shape[1]
+number_of_chunks = len(signal)//args.frames_per_chunk
+
+if args.dwt:
+    from intercom_dwt import Lifting_DWT
+    dwt = Lifting_DWT("legall53", args.frames_per_chunk, number_of_channels, 4)
+    bits_per_sample = Lifting_DWT.BITS_PER_COEFFICIENT
+else:
+    bits_per_sample = 16
+
+# The (channels, frames) unsigned sign-magnitude samples of each chunk
+chunks = []
+for chunk_number in range(number_of_chunks):
+    chunk = signal[chunk_number*args.frames_per_chunk:(chunk_number + 1)*args.frames_per_chunk].astype(np.int32)
+    if args.dwt:
+        chunk = dwt.forward(chunk, np.empty_like(chunk))
+    magnitudes = np.abs(chunk).astype(np.uint32)
+    magnitudes[chunk < 0] |= 1 << (bits_per_sample - 1)
+    chunks.append(np.ascontiguousarray(magnitudes.T))
+
+def get_regions(samples):
+    ORs = np.bitwise_or.reduce(samples, axis=1)
+    return [(c, 0, args.frames_per_chunk, b) for b in range(bits_per_sample - 1, -1, -1) for c in range(number_of_channels) if (ORs[c] >> b) & 1]
+
+def packbits(samples, regions):
+    return [np.packbits((samples[c, start:stop] >> b) & 1).tobytes() for c, start, stop, b in regions]
+
+sign_bit = bits_per_sample - 1
+coders = {"arithmetic": Arithmetic_coder(), "rice": Rice_coder()}
+
+def arithmetic(samples, regions):
+    return coders["arithmetic"].encode(samples, regions, sign_bit)
+
+def rice(samples, regions):
+    return coders["rice"].encode(samples, regions, sign_bit)
+
+for encode in (packbits, arithmetic, rice):
+    total_bytes = 0
+    encoding_time = 0
+    decoding_time = 0
+    for samples in chunks:
+        regions = get_regions(samples)
+        records = encode(samples, regions)
+        encoding_time += timeit.timeit(lambda: encode(samples, regions), number=1)
+        if encode is not packbits:
+            coder = coders[encode.__name__]
+            #Each record is preceded by its length in the packets, and
+            #the regions without record (Rice) are sent packed
+            total_bytes += sum(2 + len(record) if record is not None else (stop - start + 7)//8 for record, (c, start, stop, b) in zip(records, regions))
+            coded_regions = [region for region, record in zip(regions, records) if record is not None]
+            records = [record for record in records if record is not None]
+            bits = coder.decode(records, coded_regions, sign_bit)
+            for (c, start, stop, b), decoded in zip(coded_regions, bits):
+                assert np.array_equal(decoded, (samples[c, start:stop] >> b) & 1)
+            decoding_time += timeit.timeit(lambda: coder.decode(records, coded_regions, sign_bit), number=1)
+        else:
+            total_bytes += sum(len(record) for record in records)
+            decoding_time += timeit.timeit(lambda: [np.unpackbits(np.frombuffer(record, np.uint8)) for record in records], number=1)
+    print(f"{encode.__name__:>10}: {total_bytes/number_of_chunks:9.1f} bytes/chunk, encode {encoding_time/number_of_chunks*1e6:9.1f} us/chunk, decode {decoding_time/number_of_chunks*1e6:9.1f} us/chunk ({args.frames_per_chunk} frames x {number_of_channels} channels)")
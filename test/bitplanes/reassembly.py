@@ -0,0 +1,50 @@
+# Compares the two ways of reassembling the received bitplanes of a
+# chunk: unpacking each bitplane, converting it to the dtype of the
+# buffer, shifting and ORing (what the receivers did), and gathering
+# the shifted samples from a 256-entry table per bit position (what
+# Intercom_bitplanes.buffer_bitplane does).
+#
+# By default, 64 bitplanes (32 bits x 2 channels, as Intercom_DWT)
+# of chunks of 8192 frames.
+
+import argparse
+import timeit
+import numpy as np
+
+parser = argparse.ArgumentParser(description="Bitplane reassembly microbenchmark", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-s", "--frames_per_chunk", help="Frames per chunk.", type=int, default=8192)
+parser.add_argument("-c", "--number_of_channels", help="Number of channels.", type=int, default=2)
+parser.add_argument("-t", "--dtype", help="Type of the samples of the buffer.", type=str, default="int32")
+parser.add_argument("-n", "--number_of_chunks", help="Number of chunks to reassemble.", type=int, default=100)
+args = parser.parse_args()
+
+dtype = np.dtype(args.dtype)
+bits_per_sample = dtype.itemsize*8
+number_of_bitplanes = bits_per_sample*args.number_of_channels
+
+# The bitplanes of a random chunk, packed as they are transmitted
+chunk = np.random.default_rng(0).integers(np.iinfo(dtype).min, np.iinfo(dtype).max, (args.frames_per_chunk, args.number_of_channels), dtype=dtype, endpoint=True)
+bitplanes = [np.packbits(((chunk[:, n % args.number_of_channels] >> n//args.number_of_channels) & 1).astype(np.uint8)) for n in range(number_of_bitplanes)]
+
+cell = np.zeros_like(chunk)
+
+def unpack_shift_and_or():
+    cell.fill(0)
+    for n in range(number_of_bitplanes-1, -1, -1):
+        bitplane = np.unpackbits(bitplanes[n])
+        bitplane = bitplane.astype(dtype)
+        cell[:, n % args.number_of_channels] |= (bitplane << n//args.number_of_channels)
+
+bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(f"u{dtype.itemsize}")
+table = (bits << np.arange(bits_per_sample, dtype=bits.dtype)[:, None, None]).view(dtype)
+
+def table_lookup():
+    cell.fill(0)
+    for n in range(number_of_bitplanes-1, -1, -1):
+        cell[:, n % args.number_of_channels] |= table[n//args.number_of_channels].take(bitplanes[n], axis=0).reshape(-1)
+
+for method in (unpack_shift_and_or, table_lookup):
+    method()
+    assert np.array_equal(cell, chunk)
+    seconds = timeit.timeit(method, number=args.number_of_chunks)/args.number_of_chunks
+    print(f"{method.__name__:>20}: {seconds*1e6:9.1f} us/chunk ({number_of_bitplanes} bitplanes x {args.frames_per_chunk} frames)")
@@ -0,0 +1,104 @@
+# Compares the compressors of the payloads (see --codec of
+# Intercom_buffer): the compression ratio, the time spent compressing
+# and decompressing the payloads of each chunk, and the CPU that this
+# would use (in percentage of the period of a chunk).
+#
+# The payloads are compressed packet by packet, as they are sent:
+# either the samples (in fragments of the MTU, as Intercom_buffer) or
+# the packed significant bitplanes (as Intercom_empty). A payload that
+# does not get smaller is sent uncompressed.
+#
+# The signals are read from 16-bit WAV files (for example, a speech
+# and a music recording) or, by default, generated: "music" (a few
+# harmonics with a varying envelope) and "speech" (noise filtered
+# around a few formants, in bursts of syllables separated by pauses).
+
+import argparse
+import sys
+import time
+import wave
+import numpy as np
+
+sys.path.insert(0, ".")
+from intercom_buffer import Intercom_buffer
+
+parser = argparse.ArgumentParser(description="Payload compression benchmark", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-s", "--frames_per_chunk", help="Frames per chunk.", type=int, default=1024)
+parser.add_argument("-r", "--frames_per_second", help="Sampling rate in frames/second (of the generated signals).", type=int, default=44100)
+parser.add_argument("-n", "--number_of_chunks", help="Number of chunks.", type=int, default=100)
+parser.add_argument("-w", "--wavs", help="16-bit WAV files with the signals.", type=str, nargs="*", default=[])
+parser.add_argument("-l", "--levels", help="Compression levels.", type=int, nargs="*", default=[1, 6, 9])
+parser.add_argument("-mtu", "--mtu", help="Maximum Transmission Unit (in bytes).", type=int, default=1500)
+args = parser.parse_args()
+
+#The headers of the packets are smaller than 16 bytes
+payload_size = args.mtu - Intercom_buffer.IP_UDP_HEADERS_SIZE - 16
+
+def generate(kind):
+    rng = np.random.default_rng(0)
+    t = np.arange(args.frames_per_chunk*args.number_of_chunks)/args.frames_per_second
+    if kind == "music":
+        envelope = 0.5 + 0.5*np.sin(2*np.pi*3*t)**2
+        signal = 4000*envelope*sum(np.sin(2*np.pi*220*h*t)/h for h in range(1, 6)) + rng.normal(0, 30, len(t))
+    else:
+        noise = rng.normal(0, 1, len(t))
+        signal = np.zeros(len(t))
+        for formant, bandwidth in ((500, 80), (1500, 120), (2500, 160)):
+            spectrum = np.fft.rfft(noise)
+            frequencies = np.fft.rfftfreq(len(t), 1/args.frames_per_second)
+            signal += np.fft.irfft(spectrum*np.exp(-((frequencies - formant)/bandwidth)**2), len(t))
+        syllables = np.maximum(0, np.sin(2*np.pi*4*t))**2*(np.sin(2*np.pi*0.3*t) > -0.3)
+        signal = 8000*signal/np.std(signal)*syllables + rng.normal(0, 10, len(t))
+    signal = np.clip(signal, -32768, 32767).astype(np.int16)
+    return np.stack([signal, signal//2], axis=1)
+
+signals = {}
+for name in args.wavs:
+    with wave.open(name) as f:
+        assert f.getsampwidth() == 2
+        signals[name] = np.frombuffer(f.readframes(args.frames_per_chunk*args.number_of_chunks), np.int16).reshape(-1, f.getnchannels())
+if not signals:
+    signals = {kind: generate(kind) for kind in ("speech", "music")}
+
+# The payloads of the packets of each chunk
+def get_samples_payloads(chunk):
+    samples = chunk.astype(">i2").tobytes()
+    return [samples[i:i + payload_size] for i in range(0, len(samples), payload_size)]
+
+def get_bitplanes_payloads(chunk):
+    magnitudes = np.abs(chunk.astype(np.int32)).astype(np.uint16)
+    magnitudes[chunk < 0] |= 0x8000
+    bitplanes = [np.packbits((magnitudes[:, c] >> b) & 1).tobytes() for b in range(15, -1, -1) for c in range(chunk.shape[1]) if np.any((magnitudes[:, c] >> b) & 1)]
+    payloads = [b""]
+    for bitplane in bitplanes:
+        if len(payloads[-1]) + len(bitplane) > payload_size:
+            payloads.append(b"")
+        payloads[-1] += bitplane
+    return payloads
+
+chunk_period = args.frames_per_chunk/args.frames_per_second
+for signal_name, signal in signals.items():
+    number_of_chunks = len(signal)//args.frames_per_chunk
+    chunks = [signal[i*args.frames_per_chunk:(i + 1)*args.frames_per_chunk] for i in range(number_of_chunks)]
+    for get_payloads in (get_samples_payloads, get_bitplanes_payloads):
+        payloads = [get_payloads(chunk) for chunk in chunks]
+        raw_bytes = sum(len(payload) for chunk_payloads in payloads for payload in chunk_payloads)
+        print(f"{signal_name}, {get_payloads.__name__[4:-9]}: {raw_bytes/number_of_chunks:.1f} bytes/chunk ({len(chunks[0])} frames x {signal.shape[1]} channels)")
+        for codec in ("zlib", "lzma", "bz2"):
+            for level in args.levels:
+                compress, decompress = Intercom_buffer.get_codec(codec, level)
+                sent_bytes = 0
+                encoding_time = decoding_time = cpu_time = 0
+                for chunk_payloads in payloads:
+                    cpu_start = time.process_time()
+                    start = time.perf_counter()
+                    compressed = [compress(payload) for payload in chunk_payloads]
+                    encoding_time += time.perf_counter() - start
+                    start = time.perf_counter()
+                    decompressed = [decompress(compressed_payload) for compressed_payload in compressed]
+                    decoding_time += time.perf_counter() - start
+                    cpu_time += time.process_time() - cpu_start
+                    assert decompressed == chunk_payloads
+                    #Plus the "compressed" field
+                    sent_bytes += sum(min(len(payload), len(compressed_payload)) + 1 for payload, compressed_payload in zip(chunk_payloads, compressed))
+                print(f"{codec:>6} {level}: ratio {raw_bytes/sent_bytes:5.3f}, encode {encoding_time/number_of_chunks*1e6:8.1f} us/chunk, decode {decoding_time/number_of_chunks*1e6:8.1f} us/chunk, CPU {cpu_time/number_of_chunks/chunk_period*100:5.1f} %")
@@ -0,0 +1,211 @@
+# Runs the intercoms offline, without sound devices and faster than
+# real time, to measure their throughput, latency and quality.
+#
+# Two instances of each class (A and B) are connected by an emulated
+# link. The audio callback (record_send_and_play) of both is called
+# once per chunk, in a loop without waits: A records the signal (from
+# a 16-bit WAV file or generated) and B records silence. The chunk
+# period is emulated with a virtual clock: the packets sent at the
+# chunk i are delivered (to buffer_message, or through the loopback
+# UDP sockets of the instances to receive_and_buffer, with --link
+# udp) before the callback of the first chunk after
+# i*period + delay + jitter, where the jitter is |N(0, jitter)|
+# (so the packets can be reordered), unless they are lost.
+#
+# For each class, it shows the chunks processed per second, the time
+# (in us per chunk) spent by A sending, by B receiving and by B
+# playing (the rest of its callback), the bytes per chunk sent by A,
+# and the SNR of the signal played by B (aligned with the recorded
+# one, after the first chunks_to_buffer + 4 chunks). The options not
+# known by a class (see --options) are ignored. --pacing is not
+# emulated, and --adaptive_buffering only with the in-process link,
+# where the arrival time of the packets is the virtual time at which
+# they are delivered.
+
+import argparse
+import contextlib
+import importlib
+import io
+import select
+import sys
+import time
+import wave
+import numpy as np
+
+sys.path.insert(0, ".")
+
+CLASSES = ["Intercom", "Intercom_buffer", "Intercom_bitplanes", "Intercom_binaural", "Intercom_DFC", "Intercom_empty", "Intercom_DWT", "Intercom_subbands"]
+
+parser = argparse.ArgumentParser(description="Offline loopback harness", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-w", "--wav", help="16-bit WAV file with the signal (by default, a generated one).", type=str, default=None)
+parser.add_argument("-s", "--frames_per_chunk", help="Frames per chunk.", type=int, default=1024)
+parser.add_argument("-c", "--number_of_channels", help="Number of channels (of the generated signal).", type=int, default=2)
+parser.add_argument("-n", "--number_of_chunks", help="Number of chunks.", type=int, default=200)
+parser.add_argument("-cb", "--chunks_to_buffer", help="Number of chunks to buffer.", type=int, default=8)
+parser.add_argument("-d", "--delay", help="One-way delay of the link (in seconds).", type=float, default=0.01)
+parser.add_argument("-j", "--jitter", help="Standard deviation of the jitter of the link (in seconds).", type=float, default=0.0)
+parser.add_argument("-l", "--loss", help="Packet loss probability of the link.", type=float, default=0.0)
+parser.add_argument("-k", "--link", help="In-process link or loopback UDP sockets.", choices=["inprocess", "udp"], default="inprocess")
+parser.add_argument("-C", "--classes", help="Classes to run.", nargs="*", choices=CLASSES, default=CLASSES)
+parser.add_argument("-o", "--options", help="Options for the intercoms (for example, -o=\"-cd rice -tr legall53\").", type=str, default="")
+parser.add_argument("-p", "--port", help="First of the ports of the instances.", type=int, default=5500)
+args = parser.parse_args()
+
+if args.wav:
+    with wave.open(args.wav) as f:
+        assert f.getsampwidth() == 2
+        frames_per_second = f.getframerate()
+        signal = np.frombuffer(f.readframes(args.frames_per_chunk*args.number_of_chunks), np.int16).reshape(-1, f.getnchannels())
+else:
+    frames_per_second = 44100
+    rng = np.random.default_rng(0)
+    t = np.arange(args.frames_per_chunk*args.number_of_chunks)/frames_per_second
+    envelope = 0.5 + 0.5*np.sin(2*np.pi*3*t)**2
+    tones = sum(np.sin(2*np.pi*220*h*t)/h for h in range(1, 6))
+    signal = ((4000*envelope*tones)[:, None] + rng.normal(0, 50, (len(t), args.number_of_channels))).astype(np.int16)
+number_of_channels = signal.shape[1]
+number_of_chunks = len(signal)//args.frames_per_chunk
+chunk_period = args.frames_per_chunk/frames_per_second
+
+# Emulated link: it stores the packets with their delivery times.
+class Link:
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.now = 0.0
+        self.packets = []
+        self.sent_bytes = 0
+
+    def sendto(self, message, address):
+        message = bytes(message)
+        self.sent_bytes += len(message)
+        if self.rng.random() < args.loss:
+            return
+        self.packets.append((self.now + args.delay + abs(self.rng.normal(0, args.jitter)), message))
+
+    # Returns, sorted, the packets to deliver before the time.
+    def get_packets(self, time):
+        due = sorted((packet for packet in self.packets if packet[0] <= time), key=lambda packet: packet[0])
+        self.packets = [packet for packet in self.packets if packet[0] > time]
+        return [message for delivery_time, message in due]
+
+# Times the calls to a method of an instance.
+class Timed:
+
+    def __init__(self, method):
+        self.method = method
+        self.time = 0.0
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        result = self.method(*args)
+        self.time += time.perf_counter() - start
+        return result
+
+# The options of --options are grouped with their values, and the
+# groups that the parser of the class does not accept are ignored.
+def parse_args(parser, arguments):
+    groups = []
+    for token in args.options.split():
+        if token.startswith("-") and not token.lstrip("-").replace(".", "").isdigit():
+            groups.append([])
+        groups[-1].append(token)
+    accepted, ignored = [], []
+    for group in groups:
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                parser.parse_args(arguments + group)
+            accepted += group
+        except SystemExit:
+            ignored += group
+    return parser.parse_args(arguments + accepted), ignored
+
+def make(class_name, port, peer_port):
+    module = importlib.import_module(class_name.lower())
+    intercom = getattr(module, class_name)()
+    parser = intercom.add_args()
+    arguments = ["-p", str(port), "-i", str(peer_port), "-a", "127.0.0.1", "-s", str(args.frames_per_chunk), "-r", str(frames_per_second), "-c", str(number_of_channels)]
+    if class_name != "Intercom":
+        arguments += ["-cb", str(args.chunks_to_buffer)]
+    intercom_args, ignored = parse_args(parser, arguments)
+    if __debug__:
+        #The instances print their configuration
+        stdout = sys.stdout
+        sys.stdout = None
+    intercom.init(intercom_args)
+    if __debug__:
+        sys.stdout = stdout
+    intercom.recorded_chunk_number = 0
+    intercom.played_chunk_number = (-args.chunks_to_buffer) % getattr(intercom, "cells_in_buffer", 1)
+    intercom.pacer = None
+    return intercom, ignored
+
+def deliver(link, intercom, receive_time):
+    for message in link.get_packets(link.now):
+        if args.link == "udp":
+            link.sock.sendto(message, ("127.0.0.1", intercom.listening_port))
+        else:
+            start = time.perf_counter()
+            intercom.wakeup_time = link.now
+            intercom.buffer_message(memoryview(message))
+            receive_time[0] += time.perf_counter() - start
+    if args.link == "udp":
+        start = time.perf_counter()
+        while select.select([intercom.receiving_sock], [], [], 0)[0]:
+            intercom.receive_and_buffer()
+        receive_time[0] += time.perf_counter() - start
+
+def get_SNR(recorded, played, skip):
+    best = -np.inf
+    for lag in range(0, (args.chunks_to_buffer + 4)*args.frames_per_chunk + 1, args.frames_per_chunk):
+        x = recorded[skip*args.frames_per_chunk:len(recorded) - lag].astype(np.float64)
+        y = played[skip*args.frames_per_chunk + lag:].astype(np.float64)
+        error = np.sum((x - y)**2)
+        best = max(best, 10*np.log10(np.sum(x**2)/error) if error else np.inf)
+    return best
+
+print(f"{number_of_chunks} chunks of {args.frames_per_chunk} frames x {number_of_channels} channels ({chunk_period*1000:.1f} ms), link {args.link}: delay {args.delay*1000:.1f} ms, jitter {args.jitter*1000:.1f} ms, loss {args.loss*100:.1f} %")
+for number, class_name in enumerate(CLASSES):
+    if class_name not in args.classes:
+        continue
+    port = args.port + 2*number
+    (a, ignored), (b, _) = make(class_name, port, port + 1), make(class_name, port + 1, port)
+    links = {}
+    for sender, receiver, seed in ((a, b, 0), (b, a, 1)):
+        links[sender] = Link(np.random.default_rng(seed))
+        links[sender].sock = sender.sending_sock
+        sender.sending_sock = links[sender]
+    send = None
+    if hasattr(a, "send"):
+        send = a.send = Timed(a.send)
+        b.send = Timed(b.send)
+    receive_time = [0.0]
+    playing_time = 0.0
+    played = np.zeros_like(signal[:number_of_chunks*args.frames_per_chunk])
+    silence = np.zeros((args.frames_per_chunk, number_of_channels), np.int16)
+    #The instances show their state in stderr
+    stderr = contextlib.redirect_stderr(io.StringIO())
+    stderr.__enter__()
+    start = time.perf_counter()
+    for chunk_number in range(number_of_chunks):
+        for link in links.values():
+            link.now = chunk_number*chunk_period
+        deliver(links[b], a, [0.0])
+        deliver(links[a], b, receive_time)
+        indata = signal[chunk_number*args.frames_per_chunk:(chunk_number + 1)*args.frames_per_chunk].copy()
+        a.record_send_and_play(indata, np.empty_like(indata), args.frames_per_chunk, None, None)
+        callback_start = time.perf_counter()
+        b.record_send_and_play(silence.copy(), played[chunk_number*args.frames_per_chunk:(chunk_number + 1)*args.frames_per_chunk], args.frames_per_chunk, None, None)
+        playing_time += time.perf_counter() - callback_start
+    elapsed = time.perf_counter() - start
+    stderr.__exit__(None, None, None)
+    if send:
+        sending_time = send.time
+        playing_time -= b.send.time
+    else:
+        sending_time = playing_time/2
+        playing_time /= 2
+    for intercom in (a, b):
+        intercom.sending_sock.sock.close()
+        intercom.receiving_sock.close()
+    print(f"{class_name:>18}: {number_of_chunks/elapsed:8.1f} chunks/s, send {sending_time/number_of_chunks*1e6:8.1f} us, receive {receive_time[0]/number_of_chunks*1e6:8.1f} us, play {playing_time/number_of_chunks*1e6:8.1f} us, {links[a].sent_bytes/number_of_chunks:8.1f} bytes/chunk, SNR {get_SNR(signal, played, args.chunks_to_buffer + 4):6.1f} dB" + (f" (ignored: {' '.join(ignored)})" if ignored else ""))
@@ -0,0 +1,38 @@
+# Checks that the receiver reports of the Data-Flow Control do not
+# make the rate controllers converge worse: runs the loopback harness
+# (harness.py) with --report_interval 0 (only NORB) and with the
+# given interval, with each rate controller, and fails (exit status
+# 1) if, for some class, the SNR with reports is more than --tolerance
+# dB below the one without them.
+
+import argparse
+import re
+import subprocess
+import sys
+
+parser = argparse.ArgumentParser(description="Convergence with and without receiver reports", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-ri", "--report_interval", help="Report interval to compare with 0.", type=int, default=8)
+parser.add_argument("-rc", "--rate_controllers", help="Rate controllers.", nargs="*", default=["ewma", "delay"])
+parser.add_argument("-C", "--classes", help="Classes to run.", nargs="*", default=["Intercom_DFC", "Intercom_empty", "Intercom_subbands"])
+parser.add_argument("-t", "--tolerance", help="Tolerated SNR loss (in dB).", type=float, default=1.0)
+parser.add_argument("-n", "--number_of_chunks", help="Number of chunks.", type=int, default=400)
+parser.add_argument("-l", "--loss", help="Packet loss probability of the link.", type=float, default=0.0)
+args = parser.parse_args()
+
+# Returns {class: (bytes/chunk, SNR)}.
+def run(report_interval, rate_controller):
+    output = subprocess.run([sys.executable, "test/loopback/harness.py", "-n", str(args.number_of_chunks), "-l", str(args.loss), "-C"] + args.classes + [f"-o=-ri {report_interval} -rc {rate_controller} -tr legall53"], capture_output=True, text=True, check=True).stdout
+    results = {}
+    for class_name, bytes_per_chunk, SNR in re.findall(r"^\s*(\w+):.* ([\d.]+) bytes/chunk, SNR\s+(\S+) dB", output, re.MULTILINE):
+        results[class_name] = (float(bytes_per_chunk), float(SNR))
+    return results
+
+failed = False
+for rate_controller in args.rate_controllers:
+    without_reports, with_reports = run(0, rate_controller), run(args.report_interval, rate_controller)
+    for class_name in args.classes:
+        (bytes_0, SNR_0), (bytes_r, SNR_r) = without_reports[class_name], with_reports[class_name]
+        worse = SNR_r < SNR_0 - args.tolerance
+        failed |= worse
+        print(f"{rate_controller:>5} {class_name:>18}: -ri 0 {SNR_0:6.1f} dB {bytes_0:8.1f} bytes/chunk, -ri {args.report_interval} {SNR_r:6.1f} dB {bytes_r:8.1f} bytes/chunk" + (" WORSE" if worse else ""))
+sys.exit(1 if failed else 0)
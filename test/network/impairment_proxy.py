@@ -0,0 +1,203 @@
+# UDP relay between two intercoms that emulates the impairments of a
+# network, in both directions (independently): a token bucket
+# bandwidth limit (with a drop-tail queue), a delay distribution,
+# reordering, duplication and Gilbert-Elliott losses.
+#
+# The intercoms must send to the proxy: for example, with the proxy
+# listening at the ports 6000 (for A) and 6001 (for B),
+#
+#   python intercom_dfc.py -p 4444 -i 6000
+#   python intercom_dfc.py -p 4445 -i 6001
+#   python test/network/impairment_proxy.py -A 4444 -B 4445 -pa 6000 -pb 6001 -k 800 -d 0.03 -j 0.01
+#
+# Each packet goes through (in this order):
+#
+#   Gilbert-Elliott loss: the channel goes from the good state to the
+#     bad one with probability ge_p, and back with ge_r, at each
+#     packet, and the packet is lost with probability ge_good_loss or
+#     ge_bad_loss, depending on the state.
+#   Token bucket: the packet waits for size tokens (bytes), which are
+#     generated at "rate" kbps up to "burst" bytes. If the bytes
+#     waiting are more than "queue", the packet is dropped.
+#   Delay: constant, or delay plus a sample of the distribution
+#     (uniform in [0, 2*jitter], |normal(0, jitter)| or exponential of
+#     mean jitter). With probability "reorder", the packet is not
+#     delayed (as netem), so it overtakes the previous ones.
+#   Duplication: with probability "duplicate", the packet is also
+#     sent another time (with its own delay).
+#
+# The parameters can be changed along the time with a script: a text
+# file with lines "<seconds> <parameter>=<value> ...". For example,
+#
+#   10 rate=300 queue=4000
+#   20 rate=0 ge_p=0.01 ge_r=0.3
+#
+# The proxy is asynchronous (asyncio): the packets of each direction
+# wait in a heap (by send time, and arrival order) served by a single
+# timer of the event loop, so it handles thousands of datagrams per
+# second. With --log, a line per packet (direction, sequence number,
+# size, arrival and departure times, in seconds from the start, and
+# event: sent, duplicated, lost or dropped) is written to a CSV file.
+
+import argparse
+import asyncio
+import heapq
+import itertools
+import random
+import socket
+
+parser = argparse.ArgumentParser(description="UDP network impairment proxy", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-A", "--a_port", help="Listening port of the intercom A.", type=int, default=4444)
+parser.add_argument("-B", "--b_port", help="Listening port of the intercom B.", type=int, default=4445)
+parser.add_argument("-a", "--address", help="Address of the intercoms.", type=str, default="127.0.0.1")
+parser.add_argument("-pa", "--proxy_a_port", help="Port where the proxy receives the packets of A (for B).", type=int, default=6000)
+parser.add_argument("-pb", "--proxy_b_port", help="Port where the proxy receives the packets of B (for A).", type=int, default=6001)
+parser.add_argument("-k", "--rate", help="Bandwidth (in kbps, 0 = unlimited).", type=float, default=0)
+parser.add_argument("-bu", "--burst", help="Size of the token bucket (in bytes).", type=int, default=3000)
+parser.add_argument("-q", "--queue", help="Size of the queue of the bucket (in bytes).", type=int, default=64*1024)
+parser.add_argument("-d", "--delay", help="Constant delay (in seconds).", type=float, default=0)
+parser.add_argument("-j", "--jitter", help="Parameter of the delay distribution (in seconds).", type=float, default=0)
+parser.add_argument("-D", "--distribution", help="Distribution of the variable delay.", choices=["uniform", "normal", "exponential"], default="normal")
+parser.add_argument("-r", "--reorder", help="Probability of sending a packet without delay.", type=float, default=0)
+parser.add_argument("-u", "--duplicate", help="Probability of duplicating a packet.", type=float, default=0)
+parser.add_argument("-gp", "--ge_p", help="Gilbert-Elliott: probability of going from the good state to the bad one.", type=float, default=0)
+parser.add_argument("-gr", "--ge_r", help="Gilbert-Elliott: probability of going from the bad state to the good one.", type=float, default=1)
+parser.add_argument("-gg", "--ge_good_loss", help="Gilbert-Elliott: loss probability in the good state.", type=float, default=0)
+parser.add_argument("-gb", "--ge_bad_loss", help="Gilbert-Elliott: loss probability in the bad state.", type=float, default=1)
+parser.add_argument("-s", "--script", help="File with the changes of the parameters along the time.", type=str, default=None)
+parser.add_argument("-l", "--log", help="CSV file where the timing of each packet is written.", type=str, default=None)
+parser.add_argument("--seed", help="Seed of the random numbers.", type=int, default=None)
+args = parser.parse_args()
+
+PARAMETERS = ["rate", "burst", "queue", "delay", "jitter", "distribution", "reorder", "duplicate", "ge_p", "ge_r", "ge_good_loss", "ge_bad_loss"]
+
+# The impairments of a direction. It receives the packets of an
+# intercom and sends them to the other one.
+class Direction(asyncio.DatagramProtocol):
+
+    def __init__(self, name, destination, log):
+        self.name = name
+        self.destination = destination
+        self.log = log
+        self.random = random.Random(None if args.seed is None else f"{args.seed} {name}")
+        self.loop = asyncio.get_running_loop()
+        self.sequence_number = 0
+        self.bad_state = False
+        self.tokens = args.burst
+        self.tokens_time = start
+        self.queue_end = start                                                  # When the last packet leaves the bucket
+        self.packets = []                                                       # Heap of (send time, order, packet)
+        self.order = itertools.count()                                          # Ties are sent in arrival order
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        #Room for the bursts, if the event loop is busy
+        transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4*1024*1024)
+
+    def get_delay(self):
+        if self.random.random() < args.reorder:
+            return 0.0
+        if not args.jitter:
+            return args.delay
+        if args.distribution == "uniform":
+            return args.delay + self.random.uniform(0, 2*args.jitter)
+        if args.distribution == "normal":
+            return args.delay + abs(self.random.gauss(0, args.jitter))
+        return args.delay + self.random.expovariate(1/args.jitter)
+
+    # Time at which the packet leaves the token bucket, or None if it
+    # does not fit in the queue.
+    def get_departure_time(self, now, size):
+        if not args.rate:
+            return max(now, self.queue_end)                                     # The queued packets go first
+        rate = args.rate*1000/8
+        if (self.queue_end - now)*rate + size > args.queue:
+            return None
+        time = max(now, self.queue_end)
+        tokens = min(args.burst, self.tokens + (time - self.tokens_time)*rate)
+        if tokens >= size:
+            tokens -= size
+        else:
+            time += (size - tokens)/rate
+            tokens = 0
+        self.tokens, self.tokens_time, self.queue_end = tokens, time, time
+        return time
+
+    def datagram_received(self, data, address):
+        now = self.loop.time()
+        self.sequence_number += 1
+        self.bad_state = (self.random.random() >= args.ge_r) if self.bad_state else (self.random.random() < args.ge_p)
+        if self.random.random() < (args.ge_bad_loss if self.bad_state else args.ge_good_loss):
+            self.write_log(len(data), now, None, "lost")
+            return
+        departure_time = self.get_departure_time(now, len(data))
+        if departure_time is None:
+            self.write_log(len(data), now, None, "dropped")
+            return
+        self.send(data, now, departure_time + self.get_delay(), "sent")
+        if self.random.random() < args.duplicate:
+            self.send(data, now, departure_time + self.get_delay(), "duplicated")
+
+    def send(self, data, arrival_time, send_time, event):
+        heapq.heappush(self.packets, (send_time, next(self.order), data))
+        if self.timer is None or send_time < self.timer.when():
+            if self.timer:
+                self.timer.cancel()
+            self.timer = self.loop.call_at(send_time, self.deliver)
+        self.write_log(len(data), arrival_time, send_time, event)
+
+    def deliver(self):
+        now = self.loop.time()
+        while self.packets and self.packets[0][0] <= now:
+            self.transport.sendto(heapq.heappop(self.packets)[2], self.destination)
+        self.timer = self.loop.call_at(self.packets[0][0], self.deliver) if self.packets else None
+
+    def write_log(self, size, arrival_time, send_time, event):
+        if self.log:
+            departure = "" if send_time is None else f"{send_time - start:.6f}"
+            self.log.write(f"{self.name},{self.sequence_number},{size},{arrival_time - start:.6f},{departure},{event}\n")
+
+def read_script(file_name):
+    changes = []
+    with open(file_name) as f:
+        for line in f:
+            fields = line.split("#")[0].split()
+            if not fields:
+                continue
+            updates = {}
+            for field in fields[1:]:
+                name, value = field.split("=")
+                assert name in PARAMETERS, f"unknown parameter {name}"
+                updates[name] = value if name == "distribution" else float(value)
+            changes.append((float(fields[0]), updates))
+    return changes
+
+def apply(updates):
+    for name, value in updates.items():
+        setattr(args, name, value)
+    print(f"{asyncio.get_running_loop().time() - start:.3f} s: {' '.join(f'{name}={value}' for name, value in updates.items())}")
+
+async def main():
+    global start
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    log = open(args.log, "w", buffering=1 << 16) if args.log else None
+    if log:
+        log.write("direction,sequence_number,size,arrival_time,departure_time,event\n")
+    await loop.create_datagram_endpoint(lambda: Direction("A->B", (args.address, args.b_port), log), local_addr=("0.0.0.0", args.proxy_a_port))
+    await loop.create_datagram_endpoint(lambda: Direction("B->A", (args.address, args.a_port), log), local_addr=("0.0.0.0", args.proxy_b_port))
+    if args.script:
+        for time, updates in read_script(args.script):
+            loop.call_at(start + time, apply, updates)
+    print(f"Relaying {args.proxy_a_port} -> {args.address}:{args.b_port} and {args.proxy_b_port} -> {args.address}:{args.a_port} (CTRL + c to quit)")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        if log:
+            log.close()
+
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    pass
@@ -0,0 +1,84 @@
+# Measures the loss rate of the packets of the chunks through an
+# emulated bottleneck, sending them back-to-back (as the intercom
+# without --pacing) and paced over several fractions of the chunk
+# period (with the Pacer of Intercom_buffer).
+#
+# The bottleneck is a UDP socket of this process: each received
+# packet enters (at its arrival time) a drop-tail queue of
+# queue_size bytes which is drained at bandwidth kbps, so a packet is
+# lost if the queue is full when it arrives. Each chunk is sent as
+# bytes_per_chunk bytes in packets of at most the MTU (4096 bytes, as
+# 32 bitplanes of 1024 frames). The bandwidth is above the average
+# rate, so the losses are caused by the bursts.
+
+import argparse
+import socket
+import sys
+import threading
+import time
+import numpy as np
+
+sys.path.insert(0, ".")
+from intercom_buffer import Intercom_buffer, Pacer
+
+parser = argparse.ArgumentParser(description="Pacing over an emulated bottleneck", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-s", "--frames_per_chunk", help="Frames per chunk.", type=int, default=1024)
+parser.add_argument("-r", "--frames_per_second", help="Sampling rate in frames/second.", type=int, default=44100)
+parser.add_argument("-b", "--bytes_per_chunk", help="Bytes sent per chunk.", type=int, default=4096)
+parser.add_argument("-mtu", "--mtu", help="Maximum Transmission Unit (in bytes).", type=int, default=1500)
+parser.add_argument("-k", "--bandwidth", help="Bandwidth of the bottleneck (in kbps).", type=float, default=1800)
+parser.add_argument("-q", "--queue_size", help="Size of the queue of the bottleneck (in bytes).", type=int, default=3000)
+parser.add_argument("-n", "--number_of_chunks", help="Number of chunks sent with each fraction.", type=int, default=200)
+parser.add_argument("-f", "--fractions", help="Fractions of the chunk period (0 = no pacing).", type=float, nargs="*", default=[0, 0.25, 0.5, 0.75])
+parser.add_argument("-p", "--port", help="Port of the bottleneck.", type=int, default=4455)
+args = parser.parse_args()
+
+chunk_period = args.frames_per_chunk/args.frames_per_second
+payload_size = args.mtu - Intercom_buffer.IP_UDP_HEADERS_SIZE
+packet_sizes = [payload_size]*(args.bytes_per_chunk//payload_size) + ([args.bytes_per_chunk % payload_size] if args.bytes_per_chunk % payload_size else [])
+bandwidth = args.bandwidth*1000/8                                               # In bytes/second
+
+class Bottleneck:
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", args.port))
+        self.buffer = bytearray(65536)
+        self.reset()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def reset(self):
+        self.queue_free_time = 0.0
+        self.arrived = 0
+        self.lost = 0
+        self.queuing_delays = []
+
+    def run(self):
+        while True:
+            size = self.sock.recv_into(self.buffer) + Intercom_buffer.IP_UDP_HEADERS_SIZE
+            now = time.perf_counter()
+            self.arrived += 1
+            if max(self.queue_free_time - now, 0)*bandwidth + size > args.queue_size:
+                self.lost += 1
+                continue
+            self.queuing_delays.append(max(self.queue_free_time - now, 0))
+            self.queue_free_time = max(now, self.queue_free_time) + size/bandwidth
+
+bottleneck = Bottleneck()
+address = ("127.0.0.1", args.port)
+print(f"{len(packet_sizes)} packets/chunk ({args.bytes_per_chunk} bytes), chunk period {chunk_period*1000:.1f} ms, average rate {(args.bytes_per_chunk + len(packet_sizes)*Intercom_buffer.IP_UDP_HEADERS_SIZE)*8/chunk_period/1000:.0f} kbps, bottleneck {args.bandwidth:.0f} kbps with a queue of {args.queue_size} bytes")
+for fraction in args.fractions:
+    sending_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender = Pacer(sending_sock, fraction*chunk_period, chunk_period) if fraction else sending_sock
+    time.sleep(0.1)
+    bottleneck.reset()
+    start = time.perf_counter()
+    for chunk_number in range(args.number_of_chunks):
+        delay = start + chunk_number*chunk_period - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        for size in packet_sizes:
+            sender.sendto(bytes(size), address)
+    time.sleep(chunk_period + 0.1)
+    sent = args.number_of_chunks*len(packet_sizes)
+    print(f"pacing {fraction:4.2f}: lost {bottleneck.lost/sent*100:6.2f} % of {sent} packets ({sent - bottleneck.arrived} not arrived), queuing delay mean {np.mean(bottleneck.queuing_delays)*1000:5.2f} max {np.max(bottleneck.queuing_delays)*1000:5.2f} ms")
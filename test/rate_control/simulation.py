@@ -0,0 +1,111 @@
+# Compares the rate controllers of the Data-Flow Control (see
+# rate_controllers.py) replaying a bandwidth trace, offline and faster
+# than real time.
+#
+# The sender generates a chunk each period and sends the NOBPTS
+# bitplanes decided by the controller (frames_per_chunk/8 bytes each),
+# packed in packets of the MTU, as Intercom_DFC. The packets go
+# through a bottleneck with a drop-tail queue, whose bandwidth
+# follows the trace, and a propagation delay. The receiver measures
+# the queuing delay with Queuing_delay_estimator, and the feedback
+# (NORB and the queuing delay) reaches the sender after the playout
+# delay (chunks_to_buffer chunks), as in the intercom.
+#
+# The trace is a text file with lines "<seconds> <kbps>" (the
+# bandwidth from that time on) or, by default, steps between 300 and
+# 1500 kbps. For each controller, the mean bitplanes per chunk, the
+# utilization of the link, the queuing delay (mean, 95th percentile
+# and max) and the lost bitplanes are shown.
+
+import argparse
+import sys
+import numpy as np
+
+sys.path.insert(0, ".")
+from intercom_buffer import Intercom_buffer
+from rate_controllers import EWMA_controller, Delay_controller, Queuing_delay_estimator
+
+parser = argparse.ArgumentParser(description="Rate controllers simulation", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-t", "--trace", help="Bandwidth trace (lines \"<seconds> <kbps>\").", type=str, default=None)
+parser.add_argument("-d", "--duration", help="Seconds to simulate (by default, the trace plus 10 seconds).", type=float, default=None)
+parser.add_argument("-s", "--frames_per_chunk", help="Frames per chunk.", type=int, default=1024)
+parser.add_argument("-r", "--frames_per_second", help="Sampling rate in frames/second.", type=int, default=44100)
+parser.add_argument("-c", "--number_of_channels", help="Number of channels.", type=int, default=2)
+parser.add_argument("-cb", "--chunks_to_buffer", help="Number of chunks to buffer (the delay of the feedback).", type=int, default=32)
+parser.add_argument("-mtu", "--mtu", help="Maximum Transmission Unit (in bytes).", type=int, default=1500)
+parser.add_argument("-q", "--queue_size", help="Size of the queue of the bottleneck (in bytes).", type=int, default=64*1024)
+parser.add_argument("-pd", "--propagation_delay", help="One-way propagation delay (in seconds).", type=float, default=0.02)
+parser.add_argument("-o", "--output", help="File to write the NOBPTS and the queuing delay of each chunk.", type=str, default=None)
+args = parser.parse_args()
+
+if args.trace:
+    trace = np.loadtxt(args.trace, ndmin=2)
+else:
+    trace = np.array([[0, 1500], [10, 600], [20, 1000], [30, 300], [40, 1200]])
+trace_times = trace[:, 0]
+trace_bandwidths = trace[:, 1]*1000/8                                           # In bytes/second
+duration = args.duration or trace_times[-1] + 10
+
+chunk_period = args.frames_per_chunk/args.frames_per_second
+number_of_chunks = int(duration/chunk_period)
+max_NOBPTS = 16*args.number_of_channels
+bytes_per_bitplane = args.frames_per_chunk//8
+header_size = Intercom_buffer.IP_UDP_HEADERS_SIZE + 11 + sum(np.dtype(dtype).itemsize for name, dtype in Delay_controller.HEADER_FIELDS)
+bitplanes_per_packet = max(1, (args.mtu - header_size)//bytes_per_bitplane)
+
+def get_bandwidth(t):
+    return trace_bandwidths[np.searchsorted(trace_times, t, side="right") - 1]
+
+def simulate(controller):
+    NOBPTS = max_NOBPTS
+    sent = np.zeros(number_of_chunks, dtype=int)
+    received = np.zeros(number_of_chunks, dtype=int)
+    queuing_delays = []
+    estimated_delays = np.full(number_of_chunks, np.nan)                        # Fed back, at each chunk
+    estimator = Queuing_delay_estimator()
+    queue_free_time = 0.0                                                       # When the queue gets empty
+    delivered_bytes = 0
+    arrivals = []                                                               # (time, one-way delay) of the packets
+    for chunk_number in range(number_of_chunks):
+        now = chunk_number*chunk_period
+
+        #Feedback of the receiver about the chunk that it plays next
+        feedback_chunk = chunk_number - args.chunks_to_buffer
+        if feedback_chunk >= 0:
+            NORB, feedback_sent = received[feedback_chunk] + 1, sent[feedback_chunk]
+        else:
+            NORB, feedback_sent = max_NOBPTS, 0
+        while arrivals and arrivals[0][0] <= now - args.propagation_delay:
+            arrival_time, one_way_delay = arrivals.pop(0)
+            estimator.update(one_way_delay, arrival_time)
+        estimated_delays[chunk_number] = estimator.queuing_delay if estimator.queuing_delay is not None else np.nan
+        NOBPTS = controller.get_NOBPTS(NOBPTS, max_NOBPTS, NORB, 0, feedback_sent, estimator.queuing_delay if controller.FEEDBACK else None)
+        sent[chunk_number] = NOBPTS
+
+        #The packets of the chunk through the bottleneck
+        for first_bitplane in range(0, NOBPTS, bitplanes_per_packet):
+            bitplanes = min(bitplanes_per_packet, NOBPTS - first_bitplane)
+            size = header_size + bitplanes*bytes_per_bitplane
+            bandwidth = get_bandwidth(max(now, queue_free_time))
+            if (queue_free_time - now)*bandwidth + size > args.queue_size:
+                continue
+            queue_free_time = max(now, queue_free_time) + size/bandwidth
+            queuing_delays.append(queue_free_time - now - size/bandwidth)
+            arrivals.append((queue_free_time + args.propagation_delay, queue_free_time - now + args.propagation_delay))
+            received[chunk_number] += bitplanes
+            delivered_bytes += size
+    capacity = np.sum([get_bandwidth(chunk_number*chunk_period) for chunk_number in range(number_of_chunks)])*chunk_period
+    return sent, received, np.array(queuing_delays), estimated_delays, min(delivered_bytes/capacity, 1.0)
+
+print(f"{duration:.0f} s, {number_of_chunks} chunks of {args.frames_per_chunk} frames x {args.number_of_channels} channels, queue of {args.queue_size} bytes, propagation delay {args.propagation_delay*1000:.0f} ms")
+trajectories = {}
+for controller_class in (EWMA_controller, Delay_controller):
+    sent, received, queuing_delays, estimated_delays, utilization = simulate(controller_class())
+    trajectories[controller_class.__name__] = (sent, estimated_delays)
+    print(f"{controller_class.__name__:>16}: {np.mean(received):5.1f} bitplanes/chunk, utilization {utilization*100:5.1f} %, queuing delay mean {np.mean(queuing_delays)*1000:7.1f} p95 {np.percentile(queuing_delays, 95)*1000:7.1f} max {np.max(queuing_delays)*1000:7.1f} ms, lost bitplanes {(1 - np.sum(received)/np.sum(sent))*100:5.2f} %")
+
+if args.output:
+    columns = [np.arange(number_of_chunks)*chunk_period]
+    for sent, estimated_delays in trajectories.values():
+        columns += [sent, estimated_delays]
+    np.savetxt(args.output, np.stack(columns, axis=1), fmt="%.4f", header="time " + " ".join(f"{name}_NOBPTS {name}_queuing_delay" for name in trajectories))